@@ -0,0 +1,497 @@
+"""
+Нагрузочный прогон ботов без внешних сервисов. Обновления Telegram проходят через
+tg_bot.user_input_handler, события Messenger - через webhook.webhook и обработчик
+событий fb_worker. Вместо ElasticPath запускается mock_elasticpath.py (или используется
+уже запущенная заглушка из --store-url), геокодер, Telegram и Graph API заменены
+заглушками внутри процесса. Задержки и ошибки всех заглушек настраиваются. В конце печатается пропускная способность
+и p50/p95/p99 по каждому обработчику состояния.
+
+Бот пишет в Redis состояния, корзины и токен магазина, поэтому прогон нужно
+запускать на отдельной базе Redis:
+
+    python benchmark.py --redis-url redis://localhost:6379/15 --chats 200 --rate 50
+"""
+import argparse
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import threading
+import time
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import redis
+import requests
+
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from telegram import Update
+
+import shop
+import tg_bot
+import webhook
+
+from messenger import GRAPH_API_URL
+from mock_elasticpath import CITY_LATITUDES, CITY_LONGITUDES, MockElasticPath, start_server
+from ratelimit import TokenBucket
+from scheduler import DelayedJobs
+from tg_sender import OutboundQueue
+
+
+GEOCODER_URL = 'http://geocoder.benchmark/1.x'
+
+TG_STATE_HANDLERS = (
+    'start', 'handle_product', 'handle_menu', 'handle_cart', 'show_cart',
+    'request_address', 'get_coordinates', 'order_delivery', 'choose_payment_mode'
+)
+FB_STATE_HANDLERS = ('handle_start', 'handle_menu', 'handle_cart')
+TELEGRAM_METHODS = (
+    'send_message', 'send_photo', 'send_location', 'send_invoice',
+    'edit_message_text', 'delete_message', 'answer_callback_query'
+)
+
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, name, seconds, failed=False):
+        with self.lock:
+            self.samples[name].append(seconds)
+            if failed:
+                self.errors[name] += 1
+
+    def timed(self, name, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            started_at = time.perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.record(name, time.perf_counter() - started_at, failed)
+        return wrapper
+
+    def summary(self):
+        summary = {}
+        for name, samples in sorted(self.samples.items()):
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) * 1000
+            summary[name] = {
+                'count': len(samples),
+                'errors': self.errors[name],
+                'p50_ms': p50,
+                'p95_ms': p95,
+                'p99_ms': p99
+            }
+        return summary
+
+
+class StandInAdapter(BaseAdapter):
+    """
+    Транспорт requests, который вместо сети отдает запрос обработчику в этом же процессе.
+    Обработчик получает метод, путь, параметры строки запроса, тело и заголовки
+    и возвращает код ответа и JSON.
+    """
+
+    def __init__(self, handler, latency=0, jitter=0.25):
+        super().__init__()
+        self.handler = handler
+        self.latency = latency
+        self.jitter = jitter
+
+    def send(self, request, **kwargs):
+        if self.latency:
+            time.sleep(max(0, random.gauss(self.latency, self.latency * self.jitter)))
+        url = urlsplit(request.url)
+        body = request.body or ''
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        status, payload = self.handler(request.method, url.path, parse_qs(url.query), body, request.headers)
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'OK' if status < 400 else 'Error'
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response._content = json.dumps(payload).encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def geocoder_stand_in(method, path, params, body, headers):
+    # Координаты зависят только от адреса, чтобы повторный адрес давал ту же точку
+    digest = hashlib.sha1(params['geocode'][0].encode('utf-8')).digest()
+    lat = CITY_LATITUDES[0] + digest[0] / 255 * (CITY_LATITUDES[1] - CITY_LATITUDES[0])
+    lon = CITY_LONGITUDES[0] + digest[1] / 255 * (CITY_LONGITUDES[1] - CITY_LONGITUDES[0])
+    return 200, {'response': {'GeoObjectCollection': {'featureMember': [
+        {'GeoObject': {'Point': {'pos': f'{lon} {lat}'}}}
+    ]}}}
+
+
+def graph_stand_in(method, path, params, body, headers):
+    return 200, {'recipient_id': json.loads(body)['recipient']['id'], 'message_id': 'mid.benchmark'}
+
+
+class TelegramStandIn:
+    # Заглушка telegram.Bot: отвечает на вызовы методов после задержки
+    defaults = None
+
+    def __init__(self, recorder, latency=0, jitter=0.25):
+        self.recorder = recorder
+        self.latency = latency
+        self.jitter = jitter
+        self.message_ids = itertools.count(1)
+        for method in TELEGRAM_METHODS:
+            setattr(self, method, recorder.timed(f'telegram.{method}', self.make_method()))
+
+    def make_method(self):
+        def call(*args, chat_id=None, **kwargs):
+            if self.latency:
+                time.sleep(max(0, random.gauss(self.latency, self.latency * self.jitter)))
+            message_id = next(self.message_ids)
+            return SimpleNamespace(
+                message_id=message_id,
+                chat_id=chat_id,
+                photo=[SimpleNamespace(file_id=f'telegram-file-{message_id}')]
+            )
+        return call
+
+
+class TelegramScript:
+    # Синтетические обновления Telegram для одного покупателя от /start до оплаты
+    def __init__(self, bot, catalog, seed=0):
+        self.bot = bot
+        self.catalog = catalog
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    def chat(self, chat_id):
+        return {'id': chat_id, 'type': 'private', 'first_name': 'Benchmark'}
+
+    def message(self, chat_id, text):
+        return Update.de_json({
+            'update_id': next(self.update_ids),
+            'message': {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': self.chat(chat_id),
+                'from': dict(self.chat(chat_id), is_bot=False),
+                'text': text
+            }
+        }, self.bot)
+
+    def callback(self, chat_id, data):
+        return Update.de_json({
+            'update_id': next(self.update_ids),
+            'callback_query': {
+                'id': str(next(self.update_ids)),
+                'chat_instance': str(chat_id),
+                'from': dict(self.chat(chat_id), is_bot=False),
+                'data': data,
+                'message': {
+                    'message_id': next(self.message_ids),
+                    'date': int(time.time()),
+                    'chat': self.chat(chat_id),
+                    'text': 'Меню'
+                }
+            }
+        }, self.bot)
+
+    def order(self, chat_id):
+        product = self.random.choice(self.catalog.products)
+        courier_tg = self.random.choice(self.catalog.pizzerias)['courier_tg']
+        address = f'Москва, ул. Тестовая, д. {self.random.randint(1, 5000)}'
+        return [
+            self.message(chat_id, '/start'),
+            self.callback(chat_id, product['id']),
+            self.callback(chat_id, product['sku']),
+            self.callback(chat_id, 'show_cart'),
+            self.callback(chat_id, 'pay'),
+            self.message(chat_id, address),
+            self.callback(chat_id, f'{courier_tg}/100'),
+            self.callback(chat_id, 'cash')
+        ]
+
+
+def messenger_order(sender_id, catalog, rnd):
+    product = rnd.choice(catalog.products)
+
+    def postback(title, payload):
+        return {'sender': {'id': sender_id}, 'postback': {'title': title, 'payload': payload}}
+
+    return [
+        {'sender': {'id': sender_id}, 'message': {'text': '/start'}},
+        postback('Категория', catalog.product_categories[product['id']]),
+        postback('В корзину', product['sku']),
+        postback('Корзина', 'Корзина'),
+        postback('Добавить еще одну', product['sku']),
+        postback('К меню', 'К меню')
+    ]
+
+
+def load_telegram_updates(path, bot):
+    # Записанные обновления (по одному JSON на строку) группируются по чатам
+    scripts = defaultdict(list)
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            update = Update.de_json(json.loads(line), bot)
+            scripts[update.effective_chat.id].append(update)
+    return list(scripts.values())
+
+
+def load_messenger_events(path):
+    # Принимает и отдельные события, и тела запросов вебхука с object=page
+    scripts = defaultdict(list)
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            events = [
+                event
+                for entry in data.get('entry', [])
+                for event in entry.get('messaging', [])
+            ] if data.get('object') == 'page' else [data]
+            for event in events:
+                scripts[event['sender']['id']].append(event)
+    return list(scripts.values())
+
+
+def replay(scripts, play, rate, concurrency):
+    # События одного чата проигрываются по порядку, разные чаты - параллельно;
+    # rate ограничивает общее число событий в секунду
+    bucket = TokenBucket(rate, max(1, rate)) if rate else None
+
+    def play_script(script):
+        for item in script:
+            if bucket:
+                bucket.acquire()
+            try:
+                play(item)
+            except Exception:
+                # Ошибка уже учтена в статистике, переходим к следующему событию
+                pass
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(play_script, scripts))
+    return time.perf_counter() - started_at
+
+
+def instrument(recorder):
+    for name in TG_STATE_HANDLERS:
+        setattr(tg_bot, name, recorder.timed(f'tg.{name}', getattr(tg_bot, name)))
+    for name in FB_STATE_HANDLERS:
+        setattr(webhook, name, recorder.timed(f'fb.{name}', getattr(webhook, name)))
+
+
+def setup_stand_ins(args, db, store_url):
+    shop.set_db(db)
+    tg_bot.DB = db
+    webhook.DATABASE = db
+    # Токен от заглушки из прошлого прогона ей уже не подойдет
+    db.delete(shop.STORE_TOKEN_KEY)
+    token_manager = shop.StoreTokenManager(db, store_url, 'benchmark', 'benchmark')
+    shop.configure_client(
+        store_url,
+        token_manager=token_manager,
+        pool_size=args.concurrency + shop.FILE_LINK_WORKERS + 1
+    )
+    shop.GEOCODER_URL = GEOCODER_URL
+    shop.GEOCODER_SESSION.mount(
+        GEOCODER_URL,
+        StandInAdapter(geocoder_stand_in, args.geocoder_latency, args.jitter)
+    )
+    webhook.URL = store_url
+    webhook.STORE_TOKENS = token_manager
+    webhook.MESSENGER.session.mount(
+        GRAPH_API_URL,
+        StandInAdapter(graph_stand_in, args.graph_latency, args.jitter)
+    )
+    return token_manager
+
+
+def load_catalog(store_url):
+    # Каталог для синтетических сценариев читается в обход кэшей, чтобы не прогревать их
+    client = shop.get_client(store_url)
+    products = list(client.iter_collection('/v2/products'))
+    front_page = webhook.CATEGORIES['front_page']
+    return SimpleNamespace(
+        products=products,
+        pizzerias=list(client.iter_collection('/v2/flows/pizzeria/entries')),
+        product_categories={
+            product['id']: next(iter(
+                product.get('relationships', {}).get('categories', {}).get('data', [])
+            ), {}).get('id', front_page)
+            for product in products
+        }
+    )
+
+
+def run_telegram(args, recorder, db, store_url, catalog, token_manager):
+    bot = TelegramStandIn(recorder, args.telegram_latency, args.jitter)
+    bot_data = {
+        'base_url': store_url,
+        'pagesize': 8,
+        'store_tokens': token_manager,
+        'outbound': OutboundQueue(bot, db=db).start(),
+        # Напоминания только планируются, но не отправляются
+        'delayed_jobs': DelayedJobs(db, key='benchmark:delayed_jobs')
+    }
+    if args.telegram_updates:
+        scripts = load_telegram_updates(args.telegram_updates, bot)
+    else:
+        script = TelegramScript(bot, catalog, args.seed)
+        scripts = [script.order(args.first_chat_id + number) for number in range(args.chats)]
+    handle_update = recorder.timed('tg.update', tg_bot.user_input_handler)
+
+    def play(update):
+        context = SimpleNamespace(bot=bot, bot_data=bot_data, chat_data={}, job_queue=None)
+        handle_update(update, context)
+
+    elapsed = replay(scripts, play, args.rate, args.concurrency)
+    # Ждем, пока очередь отправки разошлет все ответы
+    drain_started_at = time.perf_counter()
+    while bot_data['outbound'].pending():
+        time.sleep(0.05)
+    db.delete('benchmark:delayed_jobs', 'benchmark:delayed_jobs:data')
+    return elapsed, time.perf_counter() - drain_started_at
+
+
+def run_messenger(args, recorder, catalog):
+    if args.messenger_events:
+        scripts = load_messenger_events(args.messenger_events)
+    else:
+        rnd = random.Random(args.seed)
+        scripts = [
+            messenger_order(f'benchmark-{number}', catalog, rnd)
+            for number in range(args.senders)
+        ]
+    client = webhook.app.test_client()
+    app_secret = os.getenv('FB_APP_SECRET')
+    handle_event = recorder.timed('fb.event', webhook.handle_messaging_event)
+
+    def post_event(event):
+        body = json.dumps({'object': 'page', 'entry': [{'messaging': [event]}]}).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if app_secret:
+            signature = hmac.new(app_secret.encode(), body, hashlib.sha256).hexdigest()
+            headers['X-Hub-Signature-256'] = f'sha256={signature}'
+        response = client.post('/', data=body, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f'Вебхук ответил {response.status_code}')
+
+    post_event = recorder.timed('fb.webhook', post_event)
+
+    def play(event):
+        # Событие проходит прием вебхуком, а затем обработку, как в fb_worker
+        post_event(event)
+        handle_event(event)
+
+    return replay(scripts, play, args.rate, args.concurrency)
+
+
+def print_report(summary, results):
+    for name, (count, elapsed) in results.items():
+        print(f'{name}: {count} событий за {elapsed:.1f} с, {count / elapsed:.1f} событий/с')
+    print()
+    print(f"{'':32}{'count':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, stats in summary.items():
+        print(
+            f"{name:32}{stats['count']:>8}{stats['errors']:>8}"
+            f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}"
+        )
+    print()
+    for cache in (shop.CATALOG_CACHE, shop.FILE_LINK_CACHE, shop.GEOCODE_CACHE):
+        requests_count = cache.hits + cache.misses
+        hit_rate = cache.hits / requests_count if requests_count else 0
+        print(f'Кэш {cache.name}: {cache.hits} попаданий, {cache.misses} промахов ({hit_rate:.0%})')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон ботов на заглушках')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/15', help='Отдельная база Redis для прогона')
+    parser.add_argument('--only', choices=['telegram', 'messenger'], help='Прогнать только одного бота')
+    parser.add_argument('--chats', type=int, default=100, help='Число синтетических чатов Telegram')
+    parser.add_argument('--senders', type=int, default=100, help='Число синтетических пользователей Messenger')
+    parser.add_argument('--first-chat-id', type=int, default=10 ** 9)
+    parser.add_argument('--telegram-updates', help='Записанные обновления Telegram, JSON по строкам')
+    parser.add_argument('--messenger-events', help='Записанные события Messenger, JSON по строкам')
+    parser.add_argument('--rate', type=float, default=0, help='Событий в секунду, 0 - без ограничения')
+    parser.add_argument('--concurrency', type=int, default=16, help='Сколько чатов обрабатывается одновременно')
+    parser.add_argument('--store-url', help='Адрес уже запущенной заглушки ElasticPath')
+    parser.add_argument('--store-latency', default='lognormal:0.08:0.3', help='Задержка ElasticPath, см. mock_elasticpath.py')
+    parser.add_argument('--store-error-rate', type=float, default=0, help='Доля ответов ElasticPath 500/503')
+    parser.add_argument('--store-burst-every', type=float, default=0, help='Период всплесков 429 от ElasticPath, с')
+    parser.add_argument('--store-burst-length', type=float, default=0, help='Длительность всплеска 429, с')
+    parser.add_argument('--geocoder-latency', type=float, default=0.1, help='Задержка геокодера, с')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='Задержка Telegram, с')
+    parser.add_argument('--graph-latency', type=float, default=0.05, help='Задержка Graph API, с')
+    parser.add_argument('--jitter', type=float, default=0.25, help='Разброс задержек, доля от среднего')
+    parser.add_argument('--products', type=int, default=40)
+    parser.add_argument('--pizzerias', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--flush-redis', action='store_true', help='Очистить базу Redis перед прогоном')
+    parser.add_argument('--output', help='Сохранить результаты в JSON для сравнения прогонов')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    db = redis.Redis.from_url(args.redis_url)
+    if args.flush_redis:
+        db.flushdb()
+    store_url = args.store_url
+    if not store_url:
+        store_url = start_server(MockElasticPath(
+            products=args.products,
+            pizzerias=args.pizzerias,
+            categories=webhook.CATEGORIES.values(),
+            seed=args.seed,
+            latency=args.store_latency,
+            error_rate=args.store_error_rate,
+            burst_every=args.store_burst_every,
+            burst_length=args.store_burst_length
+        )).url
+    token_manager = setup_stand_ins(args, db, store_url)
+    catalog = load_catalog(store_url)
+    recorder = LatencyRecorder()
+    instrument(recorder)
+
+    results = {}
+    if args.only != 'messenger':
+        elapsed, drain = run_telegram(args, recorder, db, store_url, catalog, token_manager)
+        results['Telegram'] = (len(recorder.samples['tg.update']), elapsed)
+        print(f'Очередь отправки Telegram опустела через {drain:.1f} с после прогона')
+    if args.only != 'telegram':
+        elapsed = run_messenger(args, recorder, catalog)
+        results['Messenger'] = (len(recorder.samples['fb.event']), elapsed)
+
+    summary = recorder.summary()
+    print_report(summary, results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'throughput': {name: count / elapsed for name, (count, elapsed) in results.items()},
+                'latency': summary
+            }, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import json
+import threading
+import time
+
+from collections import OrderedDict
+
+from metrics import CACHE_REQUESTS
+
+
+# Как часто (в секундах) локальный уровень сверяет поколение кэша с Redis
+GENERATION_CHECK_INTERVAL = 1
+
+class TTLCache:
+    """
+    Двухуровневый кэш: LRU в памяти процесса и необязательный Redis.
+    Каждая запись живет ttl секунд, ключ можно сбросить явно.
+    get_or_fetch гарантирует, что при одновременных запросах одного
+    отсутствующего ключа загрузка выполнится только один раз.
+    invalidate увеличивает поколение кэша в Redis; увидев новое поколение,
+    каждый процесс очищает свой локальный уровень, не дожидаясь истечения ttl.
+    """
+
+    def __init__(self, name, maxsize=256, ttl=300, db=None, check_interval=GENERATION_CHECK_INTERVAL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.db = db
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.check_interval = check_interval
+        self._generation = None
+        self._generation_checked_at = 0
+        self.hits = 0
+        self.misses = 0
+        self._hit_counter = CACHE_REQUESTS.labels(name, 'hit')
+        self._miss_counter = CACHE_REQUESTS.labels(name, 'miss')
+
+    def _redis_key(self, key):
+        return f"cache:{self.name}:{key}"
+
+    def _generation_key(self):
+        # Вне шаблона cache:<name>:*, чтобы полный сброс не удалял сам счетчик
+        return f"cache_generation:{self.name}"
+
+    def _sync_generation(self):
+        # Сверка с Redis не чаще раза в check_interval, чтобы попадание
+        # в локальный уровень обычно обходилось без сетевого запроса
+        if self.db is None:
+            return
+        now = time.monotonic()
+        if now - self._generation_checked_at < self.check_interval:
+            return
+        generation = self.db.get(self._generation_key())
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+            self._generation_checked_at = now
+
+    def get(self, key, default=None):
+        self._sync_generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    self._hit_counter.inc()
+                    return value
+                del self._entries[key]
+        raw_value = self.db.get(self._redis_key(key)) if self.db is not None else None
+        if raw_value is None:
+            self.misses += 1
+            self._miss_counter.inc()
+            return default
+        self.hits += 1
+        self._hit_counter.inc()
+        value = json.loads(raw_value)
+        ttl = self.db.ttl(self._redis_key(key))
+        self._store_local(key, value, ttl if ttl and ttl > 0 else self.ttl)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self._store_local(key, value, ttl)
+        if self.db is not None:
+            self.db.set(self._redis_key(key), json.dumps(value), ex=ttl)
+
+    def _store_local(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, key, fetch, ttl=None):
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return value
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': threading.Event()}
+                self._inflight[key] = flight
+
+        if not leader:
+            flight['event'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['value']
+
+        try:
+            value = fetch()
+            # ttl может зависеть от результата, например для отрицательного кэширования
+            self.set(key, value, ttl(value) if callable(ttl) else ttl)
+            flight['value'] = value
+            return value
+        except Exception as error:
+            flight['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight['event'].set()
+
+    def invalidate(self, key=None):
+        # Без ключа сбрасывается весь кэш, в том числе записи в Redis. Локальные
+        # копии в других процессах сбрасываются целиком при смене поколения
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+        if self.db is None:
+            return
+        if key is not None:
+            self.db.delete(self._redis_key(key))
+        else:
+            redis_keys = list(self.db.scan_iter(match=self._redis_key('*')))
+            if redis_keys:
+                self.db.delete(*redis_keys)
+        self.db.incr(self._generation_key())
@@ -0,0 +1,114 @@
+import logging
+import threading
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from shop import get_pizzerias
+
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Границы зон доставки в километрах и стоимость доставки в каждой зоне
+DELIVERY_ZONE_LIMITS = np.array([0.5, 5, 20])
+DELIVERY_ZONE_COSTS = np.array([0, 100, 300])
+PICKUP_ONLY = -1
+BATCH_SIZE = 10000
+
+PIZZERIA_INDEX = None
+PIZZERIA_INDEX_LOCK = threading.Lock()
+
+
+def to_unit_vectors(latitudes, longitudes):
+    # На единичной сфере ближайшая по хорде точка совпадает с ближайшей по дуге,
+    # поэтому поиск можно вести по обычному евклидову расстоянию
+    latitudes = np.radians(np.asarray(latitudes, dtype=float))
+    longitudes = np.radians(np.asarray(longitudes, dtype=float))
+    cos_latitudes = np.cos(latitudes)
+    return np.stack([
+        cos_latitudes * np.cos(longitudes),
+        cos_latitudes * np.sin(longitudes),
+        np.sin(latitudes)
+    ], axis=-1)
+
+
+def chord_to_km(chords):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chords) / 2, 0, 1))
+
+
+class PizzeriaIndex:
+    """
+    Пространственный индекс пиццерий. Координаты переводятся в точки на единичной
+    сфере и складываются в KD-дерево (если установлен scipy) или в массив numpy.
+    """
+
+    def __init__(self, pizzerias):
+        self.pizzerias = pizzerias
+        self.points = to_unit_vectors(
+            [pizzeria['latitude'] for pizzeria in pizzerias],
+            [pizzeria['longitude'] for pizzeria in pizzerias]
+        )
+        self.tree = cKDTree(self.points) if cKDTree else None
+        if self.tree is None:
+            # scipy указан в requirements.txt; без него поиск идет перебором всех пиццерий
+            logger.warning('scipy не установлен, ближайшая пиццерия ищется без KD-дерева')
+
+    def query(self, points, k=1):
+        k = min(k, len(self.pizzerias))
+        if self.tree is not None:
+            chords, indexes = self.tree.query(points, k=k)
+        else:
+            chords = np.sqrt(np.clip(2 - 2 * points @ self.points.T, 0, 4))
+            indexes = np.argsort(chords, axis=1)[:, :k]
+            chords = np.take_along_axis(chords, indexes, axis=1)
+        return chord_to_km(chords).reshape(len(points), k), np.asarray(indexes).reshape(len(points), k)
+
+    def nearest(self, latitude, longitude, k=1):
+        # Возвращает k ближайших пиццерий вместе с расстоянием до них в километрах
+        distances, indexes = self.query(to_unit_vectors([latitude], [longitude]), k)
+        return [
+            (self.pizzerias[index], float(distance))
+            for distance, index in zip(distances[0], indexes[0])
+        ]
+
+
+def price_deliveries(pizzeria_index, latitudes, longitudes, batch_size=BATCH_SIZE):
+    """
+    Пакетный расчет доставки для массивов координат клиентов.
+    Возвращает три массива: номер ближайшей пиццерии в pizzeria_index.pizzerias,
+    расстояние до нее в километрах и стоимость доставки (PICKUP_ONLY, если адрес
+    дальше последней зоны и возможен только самовывоз).
+    """
+    points = to_unit_vectors(latitudes, longitudes).reshape(-1, 3)
+    distances = np.empty(len(points))
+    indexes = np.empty(len(points), dtype=int)
+    # Обрабатываем точки частями, чтобы не держать в памяти матрицу на миллионы строк
+    for start in range(0, len(points), batch_size):
+        batch_distances, batch_indexes = pizzeria_index.query(points[start:start + batch_size])
+        distances[start:start + batch_size] = batch_distances[:, 0]
+        indexes[start:start + batch_size] = batch_indexes[:, 0]
+    zones = np.searchsorted(DELIVERY_ZONE_LIMITS, distances, side='left')
+    costs = np.append(DELIVERY_ZONE_COSTS, PICKUP_ONLY)[zones]
+    return indexes, distances, costs
+
+
+def price_delivery(pizzeria_index, latitude, longitude):
+    indexes, distances, costs = price_deliveries(pizzeria_index, [latitude], [longitude])
+    return pizzeria_index.pizzerias[indexes[0]], float(distances[0]), int(costs[0])
+
+
+def get_pizzeria_index(token, url):
+    # Список пиццерий берется из кэша каталога; индекс перестраивается,
+    # только когда из кэша пришел новый список
+    global PIZZERIA_INDEX
+    pizzerias = get_pizzerias(token, url)
+    with PIZZERIA_INDEX_LOCK:
+        if PIZZERIA_INDEX is None or PIZZERIA_INDEX.pizzerias is not pizzerias:
+            PIZZERIA_INDEX = PizzeriaIndex(pizzerias)
+        return PIZZERIA_INDEX
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from redis.exceptions import LockError, ResponseError
+
+from metrics import start_metrics_server
+from webhook import (
+    DATABASE, FB_DEAD_LETTER_STREAM, FB_STREAM, FB_STREAM_PARTITIONS,
+    handle_messaging_event, prerender_menus
+)
+
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_GROUP = 'fb_workers'
+PARTITION_LEASE = 30
+READ_BLOCK_MS = 5000
+# У каждого процесса свое имя потребителя: события, которые он уже прочитал,
+# не может незаметно перечитать другой воркер
+CONSUMER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+
+def ensure_group(stream):
+    try:
+        DATABASE.xgroup_create(stream, CONSUMER_GROUP, id='0', mkstream=True)
+    except ResponseError as error:
+        if 'BUSYGROUP' not in str(error):
+            raise
+
+
+def handle_entry(stream, entry_id, fields):
+    # Обработчики состояний меняют корзину до отправки ответа, поэтому повтор
+    # события целиком мог бы, например, положить пиццу в корзину второй раз.
+    # Неудачное событие сразу уходит в dead-letter поток и не задерживает
+    # следующие события этого отправителя
+    try:
+        handle_messaging_event(json.loads(fields[b'event']))
+    except Exception as error:
+        logger.exception('Не удалось обработать событие %s из %s', entry_id, stream)
+        DATABASE.xadd(FB_DEAD_LETTER_STREAM, {
+            'event': fields[b'event'],
+            'stream': stream,
+            'error': repr(error)
+        })
+    DATABASE.xack(stream, CONSUMER_GROUP, entry_id)
+
+
+def keep_lease(lock, released, lost):
+    # Продлевает аренду потока, пока воркер им владеет: обработка одного события
+    # с повторами и таймаутами Graph API может длиться дольше PARTITION_LEASE
+    while not released.wait(PARTITION_LEASE / 3):
+        try:
+            lock.extend(PARTITION_LEASE, replace_ttl=True)
+        except LockError:
+            lost.set()
+            return
+
+
+def claim_pending(stream, consumer):
+    # Забираем себе события, которые прочитал, но не подтвердил прежний владелец
+    # потока, и убираем из группы потребителей, у которых ничего не осталось
+    start_id = '0-0'
+    while True:
+        start_id, *_ = DATABASE.xautoclaim(
+            stream,
+            CONSUMER_GROUP,
+            consumer,
+            min_idle_time=0,
+            start_id=start_id,
+            count=100
+        )
+        if start_id in (b'0-0', '0-0'):
+            break
+    for info in DATABASE.xinfo_consumers(stream, CONSUMER_GROUP):
+        name = info['name'].decode('utf-8')
+        if name != consumer and not info['pending']:
+            DATABASE.xgroup_delconsumer(stream, CONSUMER_GROUP, name)
+
+
+def consume_partition(stream, lock):
+    released = threading.Event()
+    lost = threading.Event()
+    threading.Thread(target=keep_lease, args=(lock, released, lost), daemon=True).start()
+    try:
+        claim_pending(stream, CONSUMER_NAME)
+        # Сначала дочитываем свои неподтвержденные события, затем новые
+        last_id = '0'
+        while not lost.is_set():
+            response = DATABASE.xreadgroup(
+                CONSUMER_GROUP,
+                CONSUMER_NAME,
+                {stream: last_id},
+                count=10,
+                block=READ_BLOCK_MS
+            )
+            entries = response[0][1] if response else []
+            if not entries and last_id == '0':
+                last_id = '>'
+                continue
+            for entry_id, fields in entries:
+                if lost.is_set():
+                    break
+                handle_entry(stream, entry_id, fields)
+        raise LockError(f'Аренда потока {stream} истекла')
+    finally:
+        released.set()
+
+
+def run_partition(partition):
+    stream = f"{FB_STREAM}:{partition}"
+    ensure_group(stream)
+    while True:
+        # Каждый поток событий в один момент читает только один воркер
+        # thread_local=False: аренду продлевает отдельный поток keep_lease
+        lock = DATABASE.lock(f"{stream}:owner", timeout=PARTITION_LEASE, thread_local=False)
+        if not lock.acquire(blocking=False):
+            time.sleep(PARTITION_LEASE / 3)
+            continue
+        try:
+            consume_partition(stream, lock)
+        except LockError:
+            logger.warning('Потерян поток %s', stream)
+        except Exception:
+            logger.exception('Ошибка чтения потока %s', stream)
+            try:
+                lock.release()
+            except LockError:
+                pass
+            time.sleep(1)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    start_metrics_server()
+    prerender_menus()
+    threads = [
+        threading.Thread(target=run_partition, args=(partition,), daemon=True)
+        for partition in range(FB_STREAM_PARTITIONS)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()
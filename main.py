@@ -1,25 +1,199 @@
+import argparse
 import json
 import os
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import redis
 import requests
 
 from dotenv import load_dotenv
 
+from shop import PAGE_SIZE, invalidate_catalog, set_db
+
+
+MAX_ATTEMPTS = 5
+IDEMPOTENT_METHODS = {'GET', 'PUT', 'DELETE'}
+
+
+class RateLimiter:
+    # Не дает всем потокам вместе делать больше rate запросов в секунду
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
 
-def clear_catalog(url, token):
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def send_request(method, url, session=None, limiter=None, **kwargs):
+    # Запрос с повтором при 429 и ошибках сервера: ждем Retry-After либо увеличиваем паузу.
+    # 429 магазин отдает, не выполнив запрос, поэтому повторяется любой метод, а после
+    # ошибки сервера - только идемпотентные: повторный POST мог бы создать дубликат
+    session = session or requests
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter:
+            limiter.wait()
+        response = session.request(method, url, **kwargs)
+        if response.status_code < 500 and response.status_code != 429:
+            break
+        if response.status_code != 429 and method not in IDEMPOTENT_METHODS:
+            break
+        time.sleep(float(response.headers.get('Retry-After', 2 ** attempt)))
+    response.raise_for_status()
+    return response
+
+
+def iter_collection(url, token, path, session=None, limiter=None, page_size=PAGE_SIZE):
+    # Постраничный обход коллекции магазина через send_request, чтобы чтение
+    # тоже шло с общим ограничением скорости и повторами при 429
     headers = {
         'Authorization': token,
     }
-    response = requests.get(f"{url}/v2/products", headers=headers)
-    response.raise_for_status()
-    pizzas = response.json()['data']
-    for pizza in pizzas:
-        response = requests.delete(
-            f"{url}/v2/products/{pizza['id']}",
-            headers=headers
-        )
-    response = requests.get(f"{url}/v2/products", headers=headers)
-    response.raise_for_status()
+    offset = 0
+    while True:
+        items = send_request(
+            'GET',
+            f"{url}{path}",
+            session,
+            limiter,
+            headers=headers,
+            params={'page[limit]': page_size, 'page[offset]': offset}
+        ).json()['data']
+        yield from items
+        if len(items) < page_size:
+            return
+        offset += page_size
+
+
+def load_snapshot(snapshot_path):
+    # Снимок - это menu.json либо выгрузка товаров магазина со slug
+    with open(snapshot_path, encoding='utf-8') as file:
+        snapshot = json.load(file)
+    return {
+        product.get('slug') or f"pizza_{product['id']}": product
+        for product in snapshot
+    }
+
+
+def get_price(product):
+    # В menu.json цена - число, в выгрузке магазина - список цен по валютам
+    price = product.get('price')
+    return price[0]['amount'] if isinstance(price, list) else price
+
+
+def diff_snapshot(snapshot, pizzas):
+    # Что изменит восстановление каталога из снимка: каких товаров в магазине нет
+    # и у каких отличаются название или цена
+    pizzas_by_slug = {pizza['slug']: pizza for pizza in pizzas}
+    missing, changed = [], []
+    for slug, product in snapshot.items():
+        pizza = pizzas_by_slug.get(slug)
+        if not pizza:
+            missing.append(product['name'])
+            continue
+        changes = {
+            field: {'store': store_value, 'snapshot': snapshot_value}
+            for field, store_value, snapshot_value in (
+                ('name', pizza['name'], product['name']),
+                ('price', get_price(pizza), get_price(product))
+            )
+            if store_value != snapshot_value
+        }
+        if changes:
+            changed.append({'slug': slug, **changes})
+    return {'missing': missing, 'changed': changed}
+
+
+def clear_catalog(url, token, workers=8, rate=10, snapshot_path=None, dry_run=False):
+    """
+    Удаляет товары магазина в несколько потоков. Если передан снимок каталога,
+    удаляются только товары, которых в нем нет, а в отчет попадает разница между
+    снимком и магазином. Вместе с товарами удаляются их картинки, если на них
+    не ссылаются оставшиеся товары, а у оставшихся товаров - связи с уже
+    удаленными картинками. При dry_run ничего не удаляется, а только
+    возвращается отчет о том, что было бы удалено.
+    """
+    headers = {
+        'Authorization': token,
+    }
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    limiter = RateLimiter(rate)
+    # Сначала собираем id: удаление товаров во время обхода сдвигало бы страницы
+    pizzas = list(iter_collection(url, token, '/v2/products', session, limiter))
+    files = list(iter_collection(url, token, '/v2/files', session, limiter))
+    snapshot = load_snapshot(snapshot_path) if snapshot_path else {}
+    kept_pizzas = [pizza for pizza in pizzas if pizza['slug'] in snapshot]
+    removed_pizzas = [pizza for pizza in pizzas if pizza['slug'] not in snapshot]
+
+    def image_ids(pizzas):
+        return {
+            pizza['relationships']['main_image']['data']['id']
+            for pizza in pizzas
+            if pizza.get('relationships', {}).get('main_image')
+        }
+
+    # Удаляем только картинки удаляемых товаров: остальные файлы магазина могут
+    # использоваться чем-то еще, например идущим сейчас импортом
+    file_ids = {file['id'] for file in files}
+    removed_image_ids = (image_ids(removed_pizzas) - image_ids(kept_pizzas)) & file_ids
+    broken_relationships = [
+        pizza for pizza in kept_pizzas
+        if pizza.get('relationships', {}).get('main_image')
+        and pizza['relationships']['main_image']['data']['id'] not in file_ids
+    ]
+
+    report = {
+        'products': [pizza['name'] for pizza in removed_pizzas],
+        'files': sorted(removed_image_ids),
+        'relationships': [pizza['name'] for pizza in broken_relationships],
+        'failed': []
+    }
+    if snapshot_path:
+        report['snapshot'] = diff_snapshot(snapshot, pizzas)
+    if dry_run:
+        return report
+
+    def delete(path, **kwargs):
+        try:
+            send_request('DELETE', f"{url}{path}", session, limiter, headers=headers, **kwargs)
+        except requests.HTTPError as error:
+            # Уже удаленное кем-то другим считаем удаленным
+            if error.response.status_code != 404:
+                raise
+
+    tasks = [f"/v2/products/{pizza['id']}" for pizza in removed_pizzas]
+    tasks += [f"/v2/files/{file_id}" for file_id in removed_image_ids]
+    relationship_tasks = {
+        f"/v2/products/{pizza['id']}/relationships/main-image": {
+            'data': {
+                'type': 'main_image',
+                'id': pizza['relationships']['main_image']['data']['id']
+            }
+        }
+        for pizza in broken_relationships
+    }
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(delete, path): path for path in tasks}
+        futures.update({
+            executor.submit(delete, path, json=data): path
+            for path, data in relationship_tasks.items()
+        })
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except requests.RequestException as error:
+                report['failed'].append(f"{futures[future]}: {error}")
+    return report
 
     # Функция для первоначальной авторизации в магазине
 
@@ -49,21 +223,27 @@ def get_auth_token(url, client_id, store_id, client_secret):
 # Функция для загрузки картинки в магазин
 
 
-def upload_image(url, token, image_url):
+def upload_image(url, token, image_url, session=None, limiter=None):
     headers = {
         'Authorization': token,
     }
     file = {
         'file_location': (None, image_url)
     }
-    response = requests.post(f"{url}/v2/files", headers=headers, files=file)
-    response.raise_for_status()
+    response = send_request(
+        'POST',
+        f"{url}/v2/files",
+        session,
+        limiter,
+        headers=headers,
+        files=file
+    )
     return response.json()['data']['id']
 
 # Функция для создания товара в магазине
 
 
-def create_product(url, token, product_data: dict, product_image=None):
+def create_product(url, token, product_data: dict, session=None, limiter=None):
     headers = {
         'Authorization': token,
         'Content-Type': 'application/json'
@@ -86,28 +266,121 @@ def create_product(url, token, product_data: dict, product_image=None):
         'commodity_type': 'physical'
             }
     }
-    response = requests.post(
+    response = send_request(
+        'POST',
         f"{url}/v2/products",
+        session,
+        limiter,
         json=data,
         headers=headers
     )
-    response.raise_for_status()
+    return response.json()['data']['id']
 
-    if not product_image:
-        return
-    product_id = response.json()['data']['id']
+# Функция для привязки картинки к товару
+
+
+def attach_image(url, token, product_id, image_id, session=None, limiter=None):
+    headers = {
+        'Authorization': token,
+        'Content-Type': 'application/json'
+    }
     data = {
         'data': {
             'type': 'main_image',
-            'id': product_image
+            'id': image_id
         }
     }
-    response = requests.post(
+    send_request(
+        'POST',
         f"{url}/v2/products/{product_id}/relationships/main-image",
+        session,
+        limiter,
         json=data,
         headers=headers
     )
-    response.raise_for_status()
+
+
+### Массовая загрузка меню из menu.json
+
+def get_existing_products(url, token, session=None, limiter=None):
+    # Товары магазина по slug и по sku
+    products = {}
+    for product in iter_collection(url, token, '/v2/products', session, limiter):
+        products[product['slug']] = product
+        products[product['sku']] = product
+    return products
+
+
+def import_menu(url, token, menu_path, checkpoint_path, workers=8, rate=10):
+    """
+    Загружает пиццы из menu.json вместе с картинками в несколько потоков.
+    Прогресс сохраняется в checkpoint_path после каждого шага, поэтому повторный
+    запуск продолжает с места остановки: уже созданному товару только загружается
+    и привязывается картинка. Пиццы, чей slug или sku уже есть в магазине,
+    пропускаются, а если у такого товара нет картинки, она привязывается.
+    """
+    with open(menu_path, encoding='utf-8') as file:
+        menu = json.load(file)
+    checkpoint = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding='utf-8') as file:
+            checkpoint = json.load(file)
+    checkpoint_lock = threading.Lock()
+
+    def save_progress(pizza_id, **progress):
+        with checkpoint_lock:
+            checkpoint.setdefault(pizza_id, {}).update(progress)
+            temporary_path = f"{checkpoint_path}.tmp"
+            with open(temporary_path, 'w', encoding='utf-8') as file:
+                json.dump(checkpoint, file, ensure_ascii=False)
+            os.replace(temporary_path, checkpoint_path)
+
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+    limiter = RateLimiter(rate)
+    existing_products = get_existing_products(url, token, session, limiter)
+
+    def import_pizza(pizza):
+        pizza_id = str(pizza['id'])
+        progress = checkpoint.get(pizza_id, {})
+        product = (
+            existing_products.get(f"pizza_{pizza_id}")
+            or existing_products.get(str(10000 + int(pizza_id)))
+        )
+        needs_image = (
+            pizza.get('product_image')
+            and not progress.get('image_attached')
+            and not (product and product.get('relationships', {}).get('main_image'))
+        )
+        if progress.get('product_id') and not needs_image:
+            return 'done'
+        product_id = progress.get('product_id') or (product and product['id'])
+        status = 'exists' if product and not progress.get('product_id') else 'created'
+        if not product_id:
+            # id сохраняется сразу: если картинка не загрузится, при повторном
+            # запуске товар не будет создан второй раз
+            product_id = create_product(url, token, pizza, session, limiter)
+            save_progress(pizza_id, product_id=product_id)
+        if not needs_image:
+            return status
+        image_id = progress.get('image_id')
+        if not image_id:
+            image_id = upload_image(url, token, pizza['product_image']['url'], session, limiter)
+            save_progress(pizza_id, image_id=image_id)
+        attach_image(url, token, product_id, image_id, session, limiter)
+        save_progress(pizza_id, product_id=product_id, image_attached=True)
+        return 'image_attached' if status == 'exists' else status
+
+    report = {'created': 0, 'exists': 0, 'image_attached': 0, 'done': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(import_pizza, pizza): pizza for pizza in menu}
+        for future in as_completed(futures):
+            try:
+                report[future.result()] += 1
+            except requests.RequestException as error:
+                report['failed'] += 1
+                print(f"Не удалось загрузить {futures[future]['name']}: {error}")
+    return report
 
 
 ### Функция для создания Flow в магазине
@@ -252,14 +525,53 @@ def create_category(url, token, category_name, desсription=None):
     
 def main():
     load_dotenv()
+    parser = argparse.ArgumentParser(description='Наполнение магазина ElasticPath')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('categories', help='Показать категории магазина')
+    import_parser = subparsers.add_parser('import', help='Загрузить меню с картинками')
+    import_parser.add_argument('--menu', default='menu.json')
+    import_parser.add_argument('--checkpoint', default='import_checkpoint.json')
+    import_parser.add_argument('--workers', type=int, default=8)
+    import_parser.add_argument('--rate', type=float, default=10, help='Запросов в секунду')
+    clear_parser = subparsers.add_parser('clear', help='Удалить товары и неиспользуемые картинки')
+    clear_parser.add_argument('--snapshot', help='Оставить товары из этого снимка, например menu.json')
+    clear_parser.add_argument('--dry-run', action='store_true', help='Только показать, что будет удалено')
+    clear_parser.add_argument('--workers', type=int, default=8)
+    clear_parser.add_argument('--rate', type=float, default=10, help='Запросов в секунду')
+    args = parser.parse_args()
+
     url = 'https://api.moltin.com'
     shop_token, _ = get_auth_token(url, os.getenv('CLIENT_ID'), os.getenv('STORE_ID'), os.getenv('CLIENT_SECRET'))
+    if args.command == 'import':
+        print(import_menu(url, shop_token, args.menu, args.checkpoint, args.workers, args.rate))
+        reset_bot_cache()
+        return
+    if args.command == 'clear':
+        report = clear_catalog(url, shop_token, args.workers, args.rate, args.snapshot, args.dry_run)
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        if not args.dry_run:
+            reset_bot_cache()
+        return
     headers = {
         'Authorization': shop_token,
     }
     response = requests.get(url=f"{url}/v2/categories", headers=headers)
     print(response.json())
     # create_category(url, shop_token, 'spicy', 'Острые пиццы')
-    
+
+
+def reset_bot_cache():
+    # Сбрасываем общий кэш каталога, чтобы боты увидели новые товары
+    if not os.getenv('DB_HOST'):
+        return
+    set_db(redis.Redis(
+        host=os.getenv('DB_HOST'),
+        port=int(os.getenv('DB_PORT')),
+        password=os.getenv('DB_PASS'),
+        db=0
+    ))
+    invalidate_catalog()
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,112 @@
+import json
+import os
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from metrics import SEND_ERRORS, SEND_LATENCY, track
+from ratelimit import BucketRegistry, TokenBucket
+
+
+GRAPH_API_URL = 'https://graph.facebook.com/v14.0'
+# Коды ошибок Graph API о превышении лимитов: такой запрос не выполнен, и его можно повторить
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613}
+MAX_ATTEMPTS = 4
+
+
+class MessengerClient:
+    """
+    Отправка сообщений в Messenger через одну сессию с пулом соединений через прокси.
+    Отправки ограничиваются по странице и по каждому получателю. Лимит получателя
+    мягкий и срабатывает только на зацикленных отправках: ожидание блокирует поток
+    fb_worker, а с ним и других пользователей той же партиции. Повторяются только
+    запросы, которые точно не были выполнены: отклоненные из-за лимитов и не
+    дошедшие до сервера, иначе пользователь мог бы получить сообщение дважды.
+    """
+
+    def __init__(
+        self,
+        page_access_token,
+        proxy=None,
+        page_rate=None,
+        recipient_rate=None,
+        recipient_burst=10,
+        pool_size=16,
+        timeout=(3.05, 15)
+    ):
+        page_rate = page_rate or int(os.getenv('FB_PAGE_RATE', 200))
+        recipient_rate = recipient_rate or float(os.getenv('FB_RECIPIENT_RATE', 5))
+        self.session = requests.Session()
+        self.session.params = {'access_token': page_access_token}
+        if proxy:
+            self.session.proxies = {'http': proxy, 'https': proxy}
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.timeout = timeout
+        self.page_bucket = TokenBucket(page_rate, page_rate)
+        self.recipient_buckets = BucketRegistry(recipient_rate, recipient_burst)
+
+    def post(self, path, **kwargs):
+        # Время отправки учитывается вместе с ожиданием лимита и повторами
+        with track(SEND_LATENCY, SEND_ERRORS, channel='messenger', method=path):
+            return self._post(path, **kwargs)
+
+    def _post(self, path, **kwargs):
+        for attempt in range(MAX_ATTEMPTS):
+            self.page_bucket.acquire()
+            try:
+                response = self.session.post(
+                    f'{GRAPH_API_URL}/{path}',
+                    timeout=self.timeout,
+                    **kwargs
+                )
+            except requests.ConnectTimeout:
+                # Соединение не установлено, значит запрос точно не отправлен
+                if attempt == MAX_ATTEMPTS - 1:
+                    raise
+                time.sleep(2 ** attempt)
+                continue
+            if not self.is_rate_limited(response) or attempt == MAX_ATTEMPTS - 1:
+                break
+            retry_after = float(response.headers.get('Retry-After', 2 ** attempt))
+            self.page_bucket.pause(retry_after)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def is_rate_limited(response):
+        if response.status_code == 429:
+            return True
+        if response.status_code != 400:
+            return False
+        try:
+            error_code = response.json().get('error', {}).get('code')
+        except ValueError:
+            return False
+        return error_code in RATE_LIMIT_ERROR_CODES
+
+    def send(self, recipient_id, message):
+        self.recipient_buckets.get(recipient_id).acquire()
+        return self.post('me/messages', json={
+            'recipient': {'id': recipient_id},
+            'message': message
+        })
+
+    def send_serialized(self, recipient_id, message):
+        # message - уже сериализованное в JSON тело сообщения (bytes),
+        # в него подставляется только получатель
+        self.recipient_buckets.get(recipient_id).acquire()
+        body = b''.join([
+            b'{"recipient":{"id":',
+            json.dumps(recipient_id).encode('utf-8'),
+            b'},"message":',
+            message,
+            b'}'
+        ])
+        return self.post(
+            'me/messages',
+            data=body,
+            headers={'Content-Type': 'application/json'}
+        )
@@ -0,0 +1,112 @@
+import os
+import time
+
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+    generate_latest, multiprocess, start_http_server
+)
+
+
+HANDLER_LATENCY = Histogram(
+    'pizza_bot_handler_seconds',
+    'Время обработки обновления обработчиком состояния',
+    ['bot', 'state']
+)
+HANDLER_ERRORS = Counter(
+    'pizza_bot_handler_errors_total',
+    'Ошибки обработчиков состояний',
+    ['bot', 'state', 'error']
+)
+STORE_LATENCY = Histogram(
+    'pizza_bot_store_request_seconds',
+    'Время запросов к ElasticPath',
+    ['method', 'endpoint']
+)
+STORE_ERRORS = Counter(
+    'pizza_bot_store_errors_total',
+    'Неудачные запросы к ElasticPath',
+    ['method', 'endpoint', 'error']
+)
+GEOCODER_LATENCY = Histogram(
+    'pizza_bot_geocoder_seconds',
+    'Время запросов к геокодеру'
+)
+GEOCODER_ERRORS = Counter(
+    'pizza_bot_geocoder_errors_total',
+    'Неудачные запросы к геокодеру',
+    ['error']
+)
+SEND_LATENCY = Histogram(
+    'pizza_bot_send_seconds',
+    'Время отправки запросов в Telegram и Graph API',
+    ['channel', 'method']
+)
+SEND_ERRORS = Counter(
+    'pizza_bot_send_errors_total',
+    'Неудачные отправки в Telegram и Graph API',
+    ['channel', 'method', 'error']
+)
+CACHE_REQUESTS = Counter(
+    'pizza_bot_cache_requests_total',
+    'Обращения к кэшам по результату: hit или miss',
+    ['cache', 'result']
+)
+
+# Части пути ElasticPath, которые не являются идентификаторами
+STORE_PATH_WORDS = {
+    'v2', 'oauth', 'access_token', 'products', 'files', 'carts', 'items',
+    'customers', 'flows', 'entries', 'fields', 'categories', 'relationships', 'main-image'
+}
+
+
+def store_endpoint(path):
+    # /v2/carts/123/items -> /v2/carts/{id}/items, чтобы число меток не росло
+    return '/'.join(
+        part if not part or part in STORE_PATH_WORDS else '{id}'
+        for part in path.split('?')[0].rstrip('/').split('/')
+    )
+
+
+def error_label(error):
+    response = getattr(error, 'response', None)
+    status_code = getattr(response, 'status_code', None)
+    return str(status_code) if status_code else type(error).__name__
+
+
+@contextmanager
+def track(latency, errors=None, **labels):
+    # Замеряет время блока; исключение учитывается в errors и пробрасывается дальше.
+    # Пустая метка (например, состояние нового чата) заменяется на 'unknown'
+    labels = {name: 'unknown' if value is None else value for name, value in labels.items()}
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception as error:
+        if errors is not None:
+            errors.labels(error=error_label(error), **labels).inc()
+        raise
+    finally:
+        (latency.labels(**labels) if labels else latency).observe(time.perf_counter() - started_at)
+
+
+def get_registry():
+    # Под gunicorn метрики каждого воркера пишутся в PROMETHEUS_MULTIPROC_DIR
+    # и собираются вместе при каждом запросе /metrics
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view():
+    return generate_latest(get_registry()), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+
+
+def start_metrics_server():
+    # Для процессов без собственного HTTP-сервера (long polling, fb_worker)
+    port = os.getenv('METRICS_PORT')
+    if port:
+        start_http_server(int(port), registry=get_registry())
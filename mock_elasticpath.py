@@ -0,0 +1,522 @@
+"""
+Локальная заглушка API ElasticPath для прогонов без сети. Товары, картинки, корзины,
+покупатели, flows и их записи хранятся в памяти процесса. Задержка ответов, доля
+ошибок и периодические всплески 429 настраиваются, случайность задается seed,
+поэтому прогоны повторяемы.
+
+    python mock_elasticpath.py --port 8090 --latency lognormal:0.08:0.4 --error-rate 0.01 --burst-every 60 --burst-length 5
+
+Клиенту достаточно передать адрес заглушки вместо https://api.moltin.com.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+# Район, в котором стоят пиццерии заглушки
+CITY_LATITUDES = (55.55, 55.95)
+CITY_LONGITUDES = (37.35, 37.85)
+
+LATENCY_DISTRIBUTIONS = {
+    'fixed': lambda rnd, value: value,
+    'uniform': lambda rnd, low, high: rnd.uniform(low, high),
+    'normal': lambda rnd, mean, deviation: rnd.gauss(mean, deviation),
+    'lognormal': lambda rnd, median, sigma: median * rnd.lognormvariate(0, sigma),
+    'exponential': lambda rnd, mean: rnd.expovariate(1 / mean),
+}
+
+
+def parse_latency(spec):
+    # "0.05", "fixed:0.05", "uniform:0.02:0.2", "normal:0.08:0.02",
+    # "lognormal:0.08:0.5" (медиана и сигма), "exponential:0.08"
+    name, *values = str(spec).split(':')
+    if not values:
+        name, values = 'fixed', [name]
+    if name not in LATENCY_DISTRIBUTIONS:
+        raise ValueError(f'Неизвестное распределение задержки: {spec}')
+    values = [float(value) for value in values]
+    return lambda rnd: max(0, LATENCY_DISTRIBUTIONS[name](rnd, *values))
+
+
+def parse_filter(params):
+    # Поддерживается только простой фильтр вида eq(field,value)
+    match = re.fullmatch(r'eq\(([\w.]+),(.*)\)', params.get('filter', [''])[0])
+    return match.groups() if match else (None, None)
+
+
+def paginate(items, params):
+    limit = int(params.get('page[limit]', [100])[0])
+    offset = int(params.get('page[offset]', [0])[0])
+    return {
+        'data': items[offset:offset + limit],
+        'meta': {
+            'page': {'limit': limit, 'offset': offset},
+            'results': {'total': len(items)}
+        }
+    }
+
+
+def not_found(title):
+    return 404, {'errors': [{'status': 404, 'title': title}]}
+
+
+class MockElasticPath:
+    """
+    Магазин ElasticPath в памяти. handle принимает метод, путь, параметры строки
+    запроса, тело и заголовки и возвращает код ответа, JSON и дополнительные заголовки.
+    Перед ответом выдерживается задержка: общая (latency) или заданная для отдельного
+    обработчика (route_latency, по имени метода, например get_cart).
+    """
+
+    def __init__(
+        self,
+        products=40,
+        pizzerias=50,
+        categories=None,
+        seed=0,
+        latency=0,
+        route_latency=None,
+        error_rate=0,
+        burst_every=0,
+        burst_length=0,
+        token_ttl=3600
+    ):
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.latency = parse_latency(latency)
+        self.route_latency = {
+            name: parse_latency(spec)
+            for name, spec in (route_latency or {}).items()
+        }
+        self.error_rate = error_rate
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.started_at = time.monotonic()
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.requests = defaultdict(int)
+        self.lock = threading.Lock()
+
+        self.categories = list(categories or [f'category-{number}' for number in range(4)])
+        self.files = {}
+        self.products = {}
+        for number in range(products):
+            file = self.add_file(f'https://files.mock/pizza-{number}.jpg')
+            product = self.add_product({
+                'name': f'Пицца №{number}',
+                'slug': f'pizza_{number}',
+                'sku': f'pizza-{number}',
+                'description': 'Тесто, соус, сыр',
+                'price': [{
+                    'amount': self.random.randrange(300, 900, 10),
+                    'currency': 'RUB',
+                    'includes_tax': True
+                }],
+                'status': 'live'
+            })
+            product['relationships']['main_image'] = {'data': {'type': 'main_image', 'id': file['id']}}
+            product['relationships']['categories'] = {'data': [{
+                'type': 'category',
+                'id': self.categories[number % len(self.categories)]
+            }]}
+        self.flows = {}
+        self.entries = defaultdict(list)
+        self.add_flow({'name': 'Pizzeria', 'slug': 'pizzeria', 'description': 'Пиццерии'})
+        for number in range(pizzerias):
+            self.entries['pizzeria'].append({
+                'id': self.new_id(),
+                'type': 'entry',
+                'address': f'Пиццерия №{number}',
+                'alias': f'pizzeria-{number}',
+                'latitude': self.random.uniform(*CITY_LATITUDES),
+                'longitude': self.random.uniform(*CITY_LONGITUDES),
+                'courier_tg': 100000 + number
+            })
+        self.carts = defaultdict(dict)
+        self.customers = {}
+
+        self.routes = [
+            ('POST', r'/oauth/access_token', self.issue_token),
+            ('GET', r'/v2/products/?', self.list_products),
+            ('POST', r'/v2/products/?', self.create_product),
+            ('GET', r'/v2/products/(?P<product_id>[^/]+)', self.get_product),
+            ('DELETE', r'/v2/products/(?P<product_id>[^/]+)', self.delete_product),
+            ('POST', r'/v2/products/(?P<product_id>[^/]+)/relationships/main-image', self.set_main_image),
+            ('DELETE', r'/v2/products/(?P<product_id>[^/]+)/relationships/main-image', self.delete_main_image),
+            ('GET', r'/v2/files/?', self.list_files),
+            ('POST', r'/v2/files/?', self.create_file),
+            ('GET', r'/v2/files/(?P<file_id>[^/]+)', self.get_file),
+            ('DELETE', r'/v2/files/(?P<file_id>[^/]+)', self.delete_file),
+            ('GET', r'/v2/carts/(?P<cart_id>[^/]+)/items', self.get_cart),
+            ('POST', r'/v2/carts/(?P<cart_id>[^/]+)/items', self.add_cart_item),
+            ('DELETE', r'/v2/carts/(?P<cart_id>[^/]+)/items/(?P<item_id>[^/]+)', self.delete_cart_item),
+            ('GET', r'/v2/customers/?', self.list_customers),
+            ('POST', r'/v2/customers/?', self.create_customer),
+            ('GET', r'/v2/customers/(?P<customer_id>[^/]+)', self.get_customer),
+            ('PUT', r'/v2/customers/(?P<customer_id>[^/]+)', self.update_customer),
+            ('DELETE', r'/v2/customers/(?P<customer_id>[^/]+)', self.delete_customer),
+            ('GET', r'/v2/flows/?', self.list_flows),
+            ('POST', r'/v2/flows/?', self.create_flow),
+            ('GET', r'/v2/flows/(?P<slug>[^/]+)/entries', self.list_entries),
+            ('POST', r'/v2/flows/(?P<slug>[^/]+)/entries', self.create_entry),
+            ('GET', r'/v2/flows/(?P<slug>[^/]+)/entries/(?P<entry_id>[^/]+)', self.get_entry),
+        ]
+
+    def new_id(self):
+        with self.random_lock:
+            return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def roll(self):
+        with self.random_lock:
+            return self.random.random()
+
+    def sample_latency(self, name):
+        with self.random_lock:
+            return self.route_latency.get(name, self.latency)(self.random)
+
+    def burst_remaining(self):
+        # Всплеск 429 длиной burst_length секунд завершает каждый период burst_every секунд;
+        # возвращает, сколько секунд всплеску осталось, или 0 вне всплеска
+        if not self.burst_every:
+            return 0
+        remaining = self.burst_every - (time.monotonic() - self.started_at) % self.burst_every
+        return remaining if remaining <= self.burst_length else 0
+
+    def handle(self, method, path, params, body, headers):
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return (*not_found('Not Found'), {})
+
+        name = handler.__name__
+        with self.lock:
+            self.requests[name] += 1
+        time.sleep(self.sample_latency(name))
+        retry_after = self.burst_remaining()
+        if retry_after:
+            return 429, {'errors': [{'status': 429, 'title': 'Too Many Requests'}]}, {
+                'Retry-After': str(max(1, round(retry_after)))
+            }
+        if self.error_rate and self.roll() < self.error_rate:
+            status = 500 if self.roll() < 0.5 else 503
+            return status, {'errors': [{'status': status, 'title': 'Internal Server Error'}]}, {}
+        if handler != self.issue_token and not self.is_authorized(headers.get('Authorization')):
+            return 401, {'errors': [{'status': 401, 'title': 'Unauthorized'}]}, {}
+        with self.lock:
+            status, payload = handler(params, body, **match.groupdict())
+        return status, payload, {}
+
+    def is_authorized(self, authorization):
+        token = (authorization or '').replace('Bearer ', '', 1)
+        expires_at = self.tokens.get(token)
+        return bool(expires_at and expires_at > time.time())
+
+    def issue_token(self, params, body):
+        token = uuid.uuid4().hex
+        self.tokens[token] = time.time() + self.token_ttl
+        return 200, {
+            'access_token': token,
+            'token_type': 'Bearer',
+            'expires': int(self.tokens[token]),
+            'expires_in': self.token_ttl
+        }
+
+    def add_product(self, data):
+        product = dict(data, id=self.new_id(), type='product', relationships={})
+        self.products[product['id']] = product
+        return product
+
+    def product_images(self, products):
+        return {'main_images': [
+            self.files[product['relationships']['main_image']['data']['id']]
+            for product in products
+            if product['relationships'].get('main_image', {}).get('data', {}).get('id') in self.files
+        ]}
+
+    def list_products(self, params, body):
+        field, value = parse_filter(params)
+        products = list(self.products.values())
+        if field == 'category.id':
+            products = [
+                product for product in products
+                if any(
+                    category['id'] == value
+                    for category in product['relationships'].get('categories', {}).get('data', [])
+                )
+            ]
+        elif field:
+            products = [product for product in products if str(product.get(field)) == value]
+        page = paginate(products, params)
+        if 'main_image' in params.get('include', [''])[0]:
+            page['included'] = self.product_images(page['data'])
+        return 200, page
+
+    def create_product(self, params, body):
+        data = json.loads(body)['data']
+        if any(product['sku'] == data.get('sku') for product in self.products.values()):
+            return 409, {'errors': [{'status': 409, 'title': 'Duplicate sku'}]}
+        return 201, {'data': self.add_product(data)}
+
+    def get_product(self, params, body, product_id):
+        product = self.products.get(product_id)
+        if not product:
+            return not_found('Product not found')
+        response = {'data': product}
+        if 'main_image' in params.get('include', [''])[0]:
+            response['included'] = self.product_images([product])
+        return 200, response
+
+    def delete_product(self, params, body, product_id):
+        if not self.products.pop(product_id, None):
+            return not_found('Product not found')
+        return 204, None
+
+    def set_main_image(self, params, body, product_id):
+        product = self.products.get(product_id)
+        if not product:
+            return not_found('Product not found')
+        data = json.loads(body)['data']
+        product['relationships']['main_image'] = {'data': {'type': 'main_image', 'id': data['id']}}
+        return 200, {'data': data}
+
+    def delete_main_image(self, params, body, product_id):
+        product = self.products.get(product_id)
+        if not product:
+            return not_found('Product not found')
+        product['relationships'].pop('main_image', None)
+        return 204, None
+
+    def add_file(self, link):
+        file_id = self.new_id()
+        self.files[file_id] = {'id': file_id, 'type': 'file', 'link': {'href': link}}
+        return self.files[file_id]
+
+    def list_files(self, params, body):
+        return 200, paginate(list(self.files.values()), params)
+
+    def create_file(self, params, body):
+        # Поддерживается загрузка по ссылке: поле file_location в multipart-форме
+        match = re.search(r'name="file_location"\r\n\r\n(.*?)\r\n', body)
+        link = match.group(1) if match else f'https://files.mock/{uuid.uuid4().hex}.jpg'
+        return 201, {'data': self.add_file(link)}
+
+    def get_file(self, params, body, file_id):
+        if file_id not in self.files:
+            return not_found('File not found')
+        return 200, {'data': self.files[file_id]}
+
+    def delete_file(self, params, body, file_id):
+        if not self.files.pop(file_id, None):
+            return not_found('File not found')
+        return 204, None
+
+    def cart_response(self, cart_id):
+        items = list(self.carts[cart_id].values())
+        total = sum(item['unit_price']['amount'] * item['quantity'] for item in items)
+        return {'data': items, 'meta': {'display_price': {'with_tax': {'amount': total}}}}
+
+    def get_cart(self, params, body, cart_id):
+        return 200, self.cart_response(cart_id)
+
+    def add_cart_item(self, params, body, cart_id):
+        data = json.loads(body)['data']
+        product = next(
+            (product for product in self.products.values() if product['sku'] == data['sku']),
+            None
+        )
+        if not product:
+            return not_found('Product not found')
+        image_id = product['relationships'].get('main_image', {}).get('data', {}).get('id')
+        item = next(
+            (item for item in self.carts[cart_id].values() if item['sku'] == product['sku']),
+            None
+        )
+        if not item:
+            item = {
+                'id': self.new_id(),
+                'type': 'cart_item',
+                'product_id': product['id'],
+                'name': product['name'],
+                'description': product.get('description'),
+                'sku': product['sku'],
+                'quantity': 0,
+                'unit_price': {'amount': product['price'][0]['amount']},
+                'image': self.files.get(image_id, {}).get('link', {'href': None})
+            }
+            self.carts[cart_id][item['id']] = item
+        item['quantity'] += data['quantity']
+        return 201, self.cart_response(cart_id)
+
+    def delete_cart_item(self, params, body, cart_id, item_id):
+        self.carts[cart_id].pop(item_id, None)
+        return 200, self.cart_response(cart_id)
+
+    def list_customers(self, params, body):
+        field, value = parse_filter(params)
+        customers = list(self.customers.values())
+        if field:
+            customers = [customer for customer in customers if str(customer.get(field)) == value]
+        return 200, paginate(customers, params)
+
+    def create_customer(self, params, body):
+        data = json.loads(body)['data']
+        if any(customer['email'] == data['email'] for customer in self.customers.values()):
+            return 409, {'errors': [{'status': 409, 'title': 'Duplicate email'}]}
+        customer = dict(data, id=self.new_id())
+        self.customers[customer['id']] = customer
+        return 201, {'data': customer}
+
+    def get_customer(self, params, body, customer_id):
+        if customer_id not in self.customers:
+            return not_found('Customer not found')
+        return 200, {'data': self.customers[customer_id]}
+
+    def update_customer(self, params, body, customer_id):
+        if customer_id not in self.customers:
+            return not_found('Customer not found')
+        self.customers[customer_id].update(json.loads(body)['data'], id=customer_id)
+        return 200, {'data': self.customers[customer_id]}
+
+    def delete_customer(self, params, body, customer_id):
+        if not self.customers.pop(customer_id, None):
+            return not_found('Customer not found')
+        return 204, None
+
+    def add_flow(self, data):
+        flow = dict(data, id=self.new_id(), type='flow')
+        self.flows[flow['slug']] = flow
+        return flow
+
+    def list_flows(self, params, body):
+        return 200, {'data': list(self.flows.values())}
+
+    def create_flow(self, params, body):
+        data = json.loads(body)['data']
+        if data['slug'] in self.flows:
+            return 409, {'errors': [{'status': 409, 'title': 'Duplicate slug'}]}
+        return 201, {'data': self.add_flow(data)}
+
+    def list_entries(self, params, body, slug):
+        if slug not in self.flows:
+            return not_found('Flow not found')
+        return 200, paginate(self.entries[slug], params)
+
+    def create_entry(self, params, body, slug):
+        if slug not in self.flows:
+            return not_found('Flow not found')
+        entry = dict(json.loads(body)['data'], id=self.new_id(), type='entry')
+        self.entries[slug].append(entry)
+        return 201, {'data': entry}
+
+    def get_entry(self, params, body, slug, entry_id):
+        for entry in self.entries.get(slug, []):
+            if entry['id'] == entry_id:
+                return 200, {'data': entry}
+        return not_found('Entry not found')
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        status, payload, headers = self.server.store.handle(
+            self.command,
+            url.path,
+            parse_qs(url.query),
+            body,
+            self.headers
+        )
+        content = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    # Очередь входящих соединений по умолчанию (5) переполняется при параллельных
+    # клиентах, и соединения ждут повторной отправки SYN около секунды - задержку,
+    # которую никто не задавал
+    request_queue_size = 128
+
+
+def make_server(store, host='127.0.0.1', port=0):
+    # port=0 - любой свободный порт
+    server = MockServer((host, port), MockRequestHandler)
+    server.daemon_threads = True
+    server.store = store
+    server.url = f'http://{host}:{server.server_address[1]}'
+    return server
+
+
+def start_server(store, host='127.0.0.1', port=0):
+    # Запускает сервер в фоновом потоке, например внутри benchmark.py
+    server = make_server(store, host, port)
+    threading.Thread(target=server.serve_forever, name='mock_elasticpath', daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальная заглушка API ElasticPath')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--products', type=int, default=40)
+    parser.add_argument('--pizzerias', type=int, default=50)
+    parser.add_argument('--categories', help='Идентификаторы категорий через запятую')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', default='0', help='Задержка ответа, например lognormal:0.08:0.4')
+    parser.add_argument(
+        '--route-latency',
+        action='append',
+        default=[],
+        help='Задержка отдельного обработчика, например get_cart=fixed:0.3'
+    )
+    parser.add_argument('--error-rate', type=float, default=0, help='Доля ответов 500/503')
+    parser.add_argument('--burst-every', type=float, default=0, help='Период всплесков 429, с')
+    parser.add_argument('--burst-length', type=float, default=0, help='Длительность всплеска 429, с')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='Время жизни токена, с')
+    args = parser.parse_args()
+
+    store = MockElasticPath(
+        products=args.products,
+        pizzerias=args.pizzerias,
+        categories=args.categories.split(',') if args.categories else None,
+        seed=args.seed,
+        latency=args.latency,
+        route_latency=dict(spec.split('=', 1) for spec in args.route_latency),
+        error_rate=args.error_rate,
+        burst_every=args.burst_every,
+        burst_length=args.burst_length,
+        token_ttl=args.token_ttl
+    )
+    server = make_server(store, args.host, args.port)
+    print(f'ElasticPath mock: {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# Ведро в Redis пополняется и списывается одним атомарным шагом. Время передает клиент:
+# часы процессов одного бота расходятся на доли секунды, а TIME внутри скрипта
+# не везде разрешен. Возвращает, сколько секунд ждать токена; 0 - токен получен
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+else
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+return tostring(wait)
+"""
+# Сервер попросил подождать: забираем токены на это время вперед у всех процессов
+PAUSE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+tokens = math.min(tokens, 0) - tonumber(ARGV[4]) * rate
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1)
+"""
+
+
+class TokenBucket:
+    """
+    Ведро токенов: в среднем не больше rate операций в секунду,
+    кратковременно - до capacity подряд.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self):
+        # Сколько секунд осталось до появления свободного токена
+        with self.lock:
+            self._refill(time.monotonic())
+            return max(0, (1 - self.tokens) / self.rate)
+
+    def try_acquire(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def acquire(self):
+        while not self.try_acquire():
+            time.sleep(self.delay())
+
+    def pause(self, seconds):
+        # Сервер попросил подождать (Retry-After): забираем токены на это время вперед
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class RedisTokenBucket:
+    """
+    Ведро токенов в Redis, общее для всех процессов: лимит внешнего API
+    действует на бота целиком, сколько бы воркеров его ни отправляли.
+    Интерфейс тот же, что у TokenBucket.
+    """
+
+    def __init__(self, db, key, rate, capacity=1):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.take_script = db.register_script(TAKE_SCRIPT)
+        self.pause_script = db.register_script(PAUSE_SCRIPT)
+
+    def _take(self):
+        return float(self.take_script(keys=[self.key], args=[self.rate, self.capacity, time.time()]))
+
+    def try_acquire(self):
+        return self._take() == 0
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        self.pause_script(keys=[self.key], args=[self.rate, self.capacity, time.time(), seconds])
+
+
+class BucketRegistry:
+    # Ведра по ключу (например, по получателю); давно не используемые вытесняются
+    def __init__(self, rate, capacity=1, maxsize=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.maxsize = maxsize
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+                while len(self.buckets) > self.maxsize:
+                    self.buckets.popitem(last=False)
+            self.buckets.move_to_end(key)
+            return bucket
@@ -0,0 +1,211 @@
+import json
+import logging
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 60
+# Сколько секунд задача может оставаться взятой в работу без подтверждения,
+# прежде чем ее снова выполнит любой процесс
+PROCESSING_TIMEOUT = 600
+
+# Задача переносится из очереди в набор выполняемых одним атомарным шагом:
+# ее не потеряет ни падение процесса, ни одновременный schedule с тем же job_id
+CLAIM_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local job = redis.call('HGET', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+if not job then
+    return false
+end
+redis.call('HSET', KEYS[4], ARGV[1], job)
+redis.call('ZADD', KEYS[3], ARGV[2], ARGV[1])
+return job
+"""
+# Подтверждение снимает задачу, только если ее не взяли в работу заново
+ACK_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) == ARGV[2] then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+"""
+# Задачи, не подтвержденные за PROCESSING_TIMEOUT, возвращаются в очередь,
+# если за это время их не запланировали заново
+REQUEUE_SCRIPT = """
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, job_id in ipairs(job_ids) do
+    local job = redis.call('HGET', KEYS[4], job_id)
+    redis.call('ZREM', KEYS[3], job_id)
+    redis.call('HDEL', KEYS[4], job_id)
+    if job and redis.call('HEXISTS', KEYS[2], job_id) == 0 then
+        redis.call('HSET', KEYS[2], job_id, job)
+        redis.call('ZADD', KEYS[1], ARGV[1], job_id)
+    end
+end
+return #job_ids
+"""
+
+
+class DelayedJobs:
+    """
+    Отложенные задачи в Redis: идентификаторы лежат в сортированном множестве
+    с временем запуска в качестве веса, параметры - в хэше рядом.
+    Задачи переживают перезапуск процесса, а пропущенные за время простоя
+    выполняются при следующем опросе. Опрашивать множество может любое число
+    процессов: взятая в работу задача атомарно переносится в набор выполняемых
+    и снимается с него только после подтверждения. Задача, не подтвержденная
+    за processing_timeout секунд, выполняется снова.
+
+    Обычный обработчик подтверждает задачу тем, что завершился без исключения.
+    Обработчик, зарегистрированный с manual_ack=True, получает функции ack()
+    и fail(error) и вызывает одну из них сам, например после отправки сообщения.
+
+    Использование:
+
+        jobs = DelayedJobs(db)
+        jobs.register('follow_up', send_follow_up_message)
+        jobs.start()
+        jobs.schedule('follow_up', 3600, chat_id=chat_id)
+    """
+
+    def __init__(
+        self,
+        db,
+        key='delayed_jobs',
+        poll_interval=1,
+        batch_size=100,
+        processing_timeout=PROCESSING_TIMEOUT
+    ):
+        self.db = db
+        self.key = key
+        self.data_key = f"{key}:data"
+        self.processing_key = f"{key}:processing"
+        self.processing_data_key = f"{key}:processing:data"
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.processing_timeout = processing_timeout
+        self.claim_script = db.register_script(CLAIM_SCRIPT)
+        self.ack_script = db.register_script(ACK_SCRIPT)
+        self.requeue_script = db.register_script(REQUEUE_SCRIPT)
+        self.handlers = {}
+        self.thread = None
+
+    def register(self, name, handler, manual_ack=False):
+        self.handlers[name] = (handler, manual_ack)
+
+    def schedule(self, name, delay, job_id=None, attempt=0, **kwargs):
+        # Задача с тем же job_id заменяет ранее запланированную
+        job_id = job_id or uuid.uuid4().hex
+        job = {'name': name, 'kwargs': kwargs, 'attempt': attempt}
+        with self.db.pipeline() as pipe:
+            pipe.hset(self.data_key, job_id, json.dumps(job))
+            pipe.zadd(self.key, {job_id: time.time() + delay})
+            pipe.execute()
+        return job_id
+
+    def cancel(self, job_id):
+        with self.db.pipeline() as pipe:
+            pipe.zrem(self.key, job_id)
+            pipe.hdel(self.data_key, job_id)
+            pipe.execute()
+
+    def claim(self, job_id):
+        # Возвращает исходную запись задачи или None, если ее уже забрал другой процесс
+        return self.claim_script(
+            keys=[self.key, self.data_key, self.processing_key, self.processing_data_key],
+            args=[job_id, time.time() + self.processing_timeout]
+        )
+
+    def ack(self, job_id, raw_job):
+        self.ack_script(
+            keys=[self.processing_key, self.processing_data_key],
+            args=[job_id, raw_job]
+        )
+
+    def requeue_stale(self):
+        return self.requeue_script(
+            keys=[self.key, self.data_key, self.processing_key, self.processing_data_key],
+            args=[time.time(), self.batch_size]
+        )
+
+    def run_pending(self):
+        # Выполняет все задачи, срок которых наступил; возвращает их число
+        while self.requeue_stale() >= self.batch_size:
+            pass
+        done = 0
+        while True:
+            job_ids = self.db.zrangebyscore(
+                self.key, '-inf', time.time(),
+                start=0, num=self.batch_size
+            )
+            for job_id in job_ids:
+                job_id = job_id.decode('UTF-8')
+                raw_job = self.claim(job_id)
+                if raw_job:
+                    self.run(job_id, raw_job)
+                    done += 1
+            if len(job_ids) < self.batch_size:
+                return done
+
+    def run(self, job_id, raw_job):
+        job = json.loads(raw_job)
+        handler, manual_ack = self.handlers.get(job['name'], (None, False))
+        if not handler:
+            logger.error('Нет обработчика для задачи %s (%s)', job_id, job['name'])
+            self.ack(job_id, raw_job)
+            return
+
+        def ack():
+            self.ack(job_id, raw_job)
+
+        def fail(error=None):
+            logger.error('Не удалось выполнить задачу %s (%s): %s', job_id, job['name'], error)
+            if job['attempt'] + 1 < MAX_ATTEMPTS:
+                self.schedule(
+                    job['name'],
+                    RETRY_DELAY,
+                    job_id=job_id,
+                    attempt=job['attempt'] + 1,
+                    **job['kwargs']
+                )
+            ack()
+
+        try:
+            if manual_ack:
+                handler(ack=ack, fail=fail, **job['kwargs'])
+                return
+            handler(**job['kwargs'])
+        except Exception as error:
+            logger.exception('Ошибка в задаче %s (%s)', job_id, job['name'])
+            fail(error)
+            return
+        ack()
+
+    def next_run_in(self):
+        # Сколько секунд до ближайшей задачи, но не дольше интервала опроса
+        upcoming = self.db.zrange(self.key, 0, 0, withscores=True)
+        if not upcoming:
+            return self.poll_interval
+        return min(self.poll_interval, max(0, upcoming[0][1] - time.time()))
+
+    def start(self):
+        if self.thread:
+            return self
+        self.thread = threading.Thread(target=self.work, name='delayed_jobs', daemon=True)
+        self.thread.start()
+        return self
+
+    def work(self):
+        while True:
+            try:
+                self.run_pending()
+                time.sleep(self.next_run_in())
+            except Exception:
+                logger.exception('Ошибка опроса отложенных задач')
+                time.sleep(self.poll_interval)
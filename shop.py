@@ -1,84 +1,107 @@
+import json
+import logging
 import os
+import re
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
+from more_itertools import chunked
+from redis.exceptions import WatchError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def get_auth_token(url, client_id, client_secret):
-    data = {
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'grant_type': 'client_credentials'
-    }
-    response = requests.post(f'{url}/oauth/access_token', data=data)
-    response.raise_for_status()
-    auth_info = response.json()
-    return (
-        f"Bearer {auth_info.get('access_token')}",
-        auth_info.get('expires_in')
-    )
+from cache import TTLCache
+from metrics import (
+    GEOCODER_ERRORS, GEOCODER_LATENCY, STORE_ERRORS, STORE_LATENCY,
+    store_endpoint, track
+)
 
 
-def get_products(token, url, id=None):
-    headers = {
-        'Authorization': token
-    }
-    response = requests.get(
-        f'{url}/v2/products/{id if id else ""}',
-        headers=headers
-    )
-    response.raise_for_status()
-    return response.json()
+logger = logging.getLogger(__name__)
 
+CATALOG_CACHE = TTLCache(
+    'catalog',
+    maxsize=512,
+    ttl=int(os.getenv('CATALOG_CACHE_TTL', 600))
+)
+# Ссылки на файлы не меняются, пока жив сам файл, поэтому храним их долго
+FILE_LINK_CACHE = TTLCache(
+    'file_links',
+    maxsize=4096,
+    ttl=int(os.getenv('FILE_LINK_CACHE_TTL', 86400))
+)
+FILE_LINK_WORKERS = 8
 
-def get_products_by_category_id(token, url, category_id):
-    headers = {
-        'Authorization': token
-    }
-    params = {
-        'filter': f'eq(category.id,{category_id})'
-    }
-    response = requests.get(
-        f'{url}/v2/products/',
-        headers=headers,
-        params=params
-    )
-    response.raise_for_status()
-    return response.json()
- 
+GEOCODER_URL = os.getenv('YANDEX_GEOCODER_URL', 'https://geocode-maps.yandex.ru/1.x')
+GEOCODE_CACHE = TTLCache(
+    'geocode',
+    maxsize=4096,
+    ttl=int(os.getenv('GEOCODE_CACHE_TTL', 30 * 86400))
+)
+# Нераспознанные адреса помним недолго: геокодер мог их просто не знать
+GEOCODE_NEGATIVE_TTL = int(os.getenv('GEOCODE_NEGATIVE_TTL', 86400))
+GEOCODER_SESSION = requests.Session()
+ADDRESS_ABBREVIATIONS = {
+    'г': 'город',
+    'ул': 'улица',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'ш': 'шоссе',
+    'наб': 'набережная',
+    'пл': 'площадь',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'д': 'дом',
+    'к': 'корпус',
+    'корп': 'корпус',
+    'стр': 'строение',
+}
 
-def get_file_link(token, url, id):
-    headers = {
-        'Authorization': token
-    }
-    response = requests.get(
-        f"{url}/v2/files/{id}",
-        headers=headers
-    )
-    response.raise_for_status()
-    return response.json().get('data', {0: 0}).get('link', {0: 0}).get('href')
+POOL_SIZE = int(os.getenv('ELASTICPATH_POOL_SIZE', 16))
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 15
+CLIENTS = {}
+CLIENTS_LOCK = threading.Lock()
 
+DB = None
+# Хэш в Redis: имя покупателя (для бота это chat_id) -> id покупателя в магазине
+CUSTOMER_INDEX_KEY = 'customer_ids'
+PAGE_SIZE = 100
+CART_MIRROR_TTL = int(os.getenv('CART_MIRROR_TTL', 86400))
+STORE_TOKEN_KEY = 'store_token'
+# За сколько секунд до истечения токена его пора обновлять
+STORE_TOKEN_REFRESH_MARGIN = 120
 
-def add_item_to_cart(token, url, cart_id, sku, quantity):
-    headers = {
-        'Authorization': token,
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'data': {
-            'sku': sku,
-            'quantity': quantity,
-            "type": "cart_item"
-        }
-    }
-    response = requests.post(
-        f'{url}/v2/carts/{cart_id}/items',
-        headers=headers,
-        json=data
-    )
-    response.raise_for_status()
-    cart = response.json()
-    print(cart)
-    selected_data = {
+
+def set_db(db):
+    # Подключение Redis как второго уровня кэша, общего для всех процессов
+    global DB
+    DB = db
+    CATALOG_CACHE.db = db
+    FILE_LINK_CACHE.db = db
+    GEOCODE_CACHE.db = db
+
+
+def remember_file_links(products):
+    # Ответ с include=main_image уже содержит ссылки на картинки товаров
+    for image in products.get('included', {}).get('main_images', []):
+        href = image.get('link', {}).get('href')
+        if href:
+            FILE_LINK_CACHE.set(image['id'], href)
+
+
+def invalidate_catalog():
+    # Вызывается после изменения товаров или списка пиццерий в магазине
+    CATALOG_CACHE.invalidate()
+
+
+def select_cart_data(cart):
+    return {
         'items': [
             {
                 'name': item['name'],
@@ -93,64 +116,487 @@ def add_item_to_cart(token, url, cart_id, sku, quantity):
         ],
         'total_price': cart['meta']['display_price']['with_tax']['amount']
     }
-    
-    return selected_data
 
 
-def delete_item(token, url, cart_id, item_id):
-    headers = {
-        'Authorization': token
-    }
-    response = requests.delete(
-        f"{url}/v2/carts/{cart_id}/items/{item_id}",
-        headers=headers,
+def store_cart_mirror(cart_id, version, cart):
+    # Версия не дает ответу более раннего запроса затереть более свежую корзину
+    key = f"cart_mirror:{cart_id}"
+    with DB.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            mirror = pipe.get(key)
+            if mirror and json.loads(mirror)['version'] > version:
+                return
+            pipe.multi()
+            pipe.set(key, json.dumps({'version': version, 'cart': cart}), ex=CART_MIRROR_TTL)
+            pipe.execute()
+        except WatchError:
+            pass
+
+
+def bump_cart_version(cart_id):
+    # Счетчик живет столько же, сколько копия корзины, иначе брошенные корзины
+    # оставляли бы в Redis ключи навсегда
+    key = f"cart_version:{cart_id}"
+    with DB.pipeline() as pipe:
+        pipe.incr(key)
+        pipe.expire(key, CART_MIRROR_TTL)
+        version, _ = pipe.execute()
+    return version
+
+
+def read_cart_mirror(cart_id):
+    # Копия корзины годится, только если после нее не начиналось других изменений
+    mirror, version = DB.mget(f"cart_mirror:{cart_id}", f"cart_version:{cart_id}")
+    version = int(version or 0)
+    if mirror:
+        mirror = json.loads(mirror)
+        if mirror['version'] == version:
+            return mirror['cart'], version
+    return None, version
+
+
+class StoreTokenManager:
+    """
+    Общий для всех процессов токен магазина. Токен и время его истечения хранятся
+    в Redis, обновление выполняется заранее и под распределенной блокировкой,
+    поэтому за новым токеном в /oauth/access_token ходит только один процесс.
+    """
+
+    def __init__(self, db, url, client_id, client_secret, refresh_margin=STORE_TOKEN_REFRESH_MARGIN):
+        self.db = db
+        self.url = url
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+
+    def is_fresh(self, token, expires_at):
+        return token and time.time() < expires_at - self.refresh_margin
+
+    def read_shared_token(self):
+        token, expires_at = self.db.hmget(STORE_TOKEN_KEY, 'token', 'expires_at')
+        if not token:
+            return None, 0
+        return token.decode('utf-8'), float(expires_at)
+
+    def get(self):
+        if self.is_fresh(self.token, self.expires_at):
+            return self.token
+        token, expires_at = self.read_shared_token()
+        if self.is_fresh(token, expires_at):
+            self.token, self.expires_at = token, expires_at
+            return token
+        return self.refresh()
+
+    def refresh(self, stale_token=None):
+        # stale_token - токен, который магазин только что отверг с ответом 401
+        with self.db.lock(f"{STORE_TOKEN_KEY}_lock", timeout=30, blocking_timeout=30):
+            # Пока ждали блокировку, токен мог обновить другой процесс
+            token, expires_at = self.read_shared_token()
+            if self.is_fresh(token, expires_at) and token != stale_token:
+                self.token, self.expires_at = token, expires_at
+                return token
+            token, lifetime = get_client(self.url).get_auth_token(
+                self.client_id,
+                self.client_secret
+            )
+            expires_at = time.time() + int(lifetime)
+            self.db.hset(STORE_TOKEN_KEY, mapping={'token': token, 'expires_at': expires_at})
+            self.db.expireat(STORE_TOKEN_KEY, int(expires_at))
+            self.token, self.expires_at = token, expires_at
+            return token
+
+
+class ElasticPathClient:
+    """
+    Клиент ElasticPath поверх одной requests.Session: соединения с api.moltin.com
+    переиспользуются между запросами, а заголовок авторизации и таймауты
+    подставляются автоматически.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        token=None,
+        token_manager=None,
+        pool_size=POOL_SIZE,
+        timeout=None,
+        retries=2
+    ):
+        self.base_url = base_url
+        # Токен можно передать строкой или функцией, возвращающей актуальный токен
+        self.token = token or (token_manager.get if token_manager else None)
+        self.token_manager = token_manager
+        self.timeout = timeout or (CONNECT_TIMEOUT, READ_TIMEOUT)
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'PUT', 'DELETE']),
+            # После последней попытки отдаем ответ как есть, чтобы raise_for_status
+            # выбросил HTTPError, а не RetryError
+            raise_on_status=False
         )
-    response.raise_for_status()
-    cart = response.json()
-    selected_data = {
-        'items': [
-            {
-                'name': item['name'],
-                'quantity': item['quantity'],
-                'unit_price': item['unit_price']['amount'],
-                'id': item['id'],
-                'image': item['image']['href'],
-                'description': item.get('description'),
-                'sku': item['sku']
+        # pool_maxsize должен быть не меньше числа потоков, одновременно
+        # обращающихся к магазину, иначе лишние соединения будут закрываться
+        adapter = HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=pool_size,
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_token(self, token=None):
+        if token:
+            return token
+        if callable(self.token):
+            return self.token()
+        return self.token
+
+    def request(self, method, path, token=None, **kwargs):
+        headers = kwargs.pop('headers', {})
+        token = self.get_token(token)
+        if token:
+            headers['Authorization'] = token
+        kwargs.setdefault('timeout', self.timeout)
+        with track(STORE_LATENCY, STORE_ERRORS, method=method, endpoint=store_endpoint(path)):
+            response = self.session.request(
+                method,
+                f'{self.base_url}{path}',
+                headers=headers,
+                **kwargs
+            )
+            if response.status_code == 401 and token and self.token_manager:
+                # Токен отозван или истек раньше срока: обновляем и повторяем запрос один раз
+                headers['Authorization'] = self.token_manager.refresh(stale_token=token)
+                response = self.session.request(
+                    method,
+                    f'{self.base_url}{path}',
+                    headers=headers,
+                    **kwargs
+                )
+            response.raise_for_status()
+        return response
+
+    def get_auth_token(self, client_id, client_secret):
+        data = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'grant_type': 'client_credentials'
+        }
+        with track(STORE_LATENCY, STORE_ERRORS, method='POST', endpoint='/oauth/access_token'):
+            response = self.session.post(
+                f'{self.base_url}/oauth/access_token',
+                data=data,
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+        auth_info = response.json()
+        return (
+            f"Bearer {auth_info.get('access_token')}",
+            auth_info.get('expires_in')
+        )
+
+    def iter_collection(
+        self,
+        path,
+        token=None,
+        params=None,
+        page_size=PAGE_SIZE,
+        prefetch=True,
+        on_page=None
+    ):
+        """
+        Постраничный обход коллекции ElasticPath (/v2/products, /v2/customers,
+        /v2/flows/<slug>/entries, /v2/files). Элементы отдаются по одному, следующая
+        страница при prefetch=True загружается в фоне, пока обрабатывается текущая.
+        Если вызывающий код прервет перебор, лишние страницы загружаться не будут.
+        on_page получает ответ каждой страницы целиком, например ради included.
+        """
+        def fetch_page(offset):
+            page_params = dict(params or {}, **{'page[limit]': page_size, 'page[offset]': offset})
+            page = self.request('GET', path, token, params=page_params).json()
+            if on_page:
+                on_page(page)
+            return page['data']
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        next_page = None
+        try:
+            offset = 0
+            items = fetch_page(offset)
+            while items:
+                has_next_page = len(items) >= page_size
+                if has_next_page and executor:
+                    next_page = executor.submit(fetch_page, offset + page_size)
+                yield from items
+                if not has_next_page:
+                    return
+                offset += page_size
+                items = next_page.result() if executor else fetch_page(offset)
+                next_page = None
+        finally:
+            if next_page:
+                next_page.cancel()
+            if executor:
+                executor.shutdown(wait=False)
+
+    def get_products(self, id=None, token=None):
+        def fetch():
+            if not id:
+                return {'data': list(self.iter_collection(
+                    '/v2/products',
+                    token,
+                    params={'include': 'main_image'},
+                    on_page=remember_file_links
+                ))}
+            products = self.request(
+                'GET',
+                f'/v2/products/{id}',
+                token,
+                params={'include': 'main_image'}
+            ).json()
+            remember_file_links(products)
+            return products
+
+        return CATALOG_CACHE.get_or_fetch(f"{self.base_url}:products:{id or ''}", fetch)
+
+    def get_products_by_category_id(self, category_id, token=None):
+        def fetch():
+            params = {
+                'filter': f'eq(category.id,{category_id})',
+                'include': 'main_image'
             }
-            for item in cart['data']
-        ],
-        'total_price': cart['meta']['display_price']['with_tax']['amount']
-    }    
-    return selected_data
+            return {'data': list(self.iter_collection(
+                '/v2/products',
+                token,
+                params=params,
+                on_page=remember_file_links
+            ))}
 
+        return CATALOG_CACHE.get_or_fetch(f"{self.base_url}:category:{category_id}", fetch)
 
-def get_cart(token, url, cart_id):
-    headers = {
-        'Authorization': token
-    }
-    response = requests.get(
-        f'{url}/v2/carts/{cart_id}/items',
-        headers=headers
-    )
-    response.raise_for_status()
-    cart = response.json()
-    selected_data = {
-        'items': [
-            {
-                'name': item['name'],
-                'quantity': item['quantity'],
-                'unit_price': item['unit_price']['amount'],
-                'id': item['id'],
-                'image': item['image']['href'],
-                'description': item.get('description'),
-                'sku': item['sku']
+    def get_file_link(self, id, token=None):
+        def fetch():
+            response = self.request('GET', f'/v2/files/{id}', token)
+            return response.json().get('data', {0: 0}).get('link', {0: 0}).get('href')
+
+        return FILE_LINK_CACHE.get_or_fetch(id, fetch)
+
+    def get_file_links(self, file_ids, token=None):
+        # Недостающие ссылки запрашиваются параллельно, а не по одной
+        file_ids = list(dict.fromkeys(file_ids))
+        links = {file_id: FILE_LINK_CACHE.get(file_id) for file_id in file_ids}
+        missing_ids = [file_id for file_id, link in links.items() if not link]
+        if missing_ids:
+            with ThreadPoolExecutor(max_workers=FILE_LINK_WORKERS) as executor:
+                fetched_links = executor.map(
+                    lambda file_id: self.get_file_link(file_id, token),
+                    missing_ids
+                )
+                links.update(zip(missing_ids, fetched_links))
+        return links
+
+    def get_product_image_links(self, products, token=None):
+        image_ids = {
+            product['id']: product['relationships']['main_image']['data']['id']
+            for product in products
+            if product.get('relationships', {}).get('main_image')
+        }
+        links = self.get_file_links(image_ids.values(), token)
+        return {
+            product_id: links.get(image_id)
+            for product_id, image_id in image_ids.items()
+        }
+
+    def add_item_to_cart(self, cart_id, sku, quantity, token=None):
+        data = {
+            'data': {
+                'sku': sku,
+                'quantity': quantity,
+                "type": "cart_item"
             }
-            for item in cart['data']
-        ],
-        'total_price': cart['meta']['display_price']['with_tax']['amount']
-    }    
-    return selected_data
+        }
+        return self.change_cart(
+            cart_id,
+            lambda: self.request('POST', f'/v2/carts/{cart_id}/items', token, json=data)
+        )
+
+    def delete_item(self, cart_id, item_id, token=None):
+        return self.change_cart(
+            cart_id,
+            lambda: self.request('DELETE', f'/v2/carts/{cart_id}/items/{item_id}', token)
+        )
+
+    def change_cart(self, cart_id, send_request):
+        # Версия увеличивается до запроса: если он не завершится, копия корзины
+        # в Redis станет недействительной и будет перечитана из магазина
+        version = bump_cart_version(cart_id) if DB is not None else None
+        cart = send_request().json()
+        logger.debug('Корзина %s после изменения: %s', cart_id, cart)
+        cart = select_cart_data(cart)
+        if DB is not None:
+            store_cart_mirror(cart_id, version, cart)
+        return cart
+
+    def get_cart(self, cart_id, token=None, fresh=False):
+        # fresh=True принудительно сверяет корзину с магазином, например перед оформлением заказа
+        if DB is None:
+            return select_cart_data(self.request('GET', f'/v2/carts/{cart_id}/items', token).json())
+        cart, version = read_cart_mirror(cart_id)
+        if cart is not None and not fresh:
+            return cart
+        cart = select_cart_data(self.request('GET', f'/v2/carts/{cart_id}/items', token).json())
+        store_cart_mirror(cart_id, version, cart)
+        return cart
+
+    def create_or_update_customer(
+        self,
+        user_name,
+        user_email=None,
+        address=None,
+        latitude=None,
+        longitude=None,
+        token=None
+    ):
+        data = {
+            'data': {
+                'type': 'customer',
+                'name': user_name,
+                'email': (user_email if user_email else f"{user_name}@email.com"),
+                'latitude': latitude,
+                'longitude': longitude,
+                'address': address
+            }
+        }
+        if DB is None:
+            customers = self.request('GET', '/v2/customers', token).json()
+            for customer in customers['data']:
+                if customer.get('name') == user_name:
+                    return self.request(
+                        'PUT',
+                        f"/v2/customers/{customer['id']}",
+                        token,
+                        json=data
+                    ).json()
+            return self.request('POST', '/v2/customers', token, json=data).json()
+
+        customer_id = DB.hget(CUSTOMER_INDEX_KEY, user_name)
+        if customer_id:
+            try:
+                return self.request(
+                    'PUT',
+                    f"/v2/customers/{customer_id.decode('utf-8')}",
+                    token,
+                    json=data
+                ).json()
+            except requests.HTTPError as error:
+                if error.response.status_code != 404:
+                    raise
+                # Покупателя удалили в магазине - убираем устаревшую запись из индекса
+                DB.hdel(CUSTOMER_INDEX_KEY, user_name)
+
+        try:
+            customer = self.request('POST', '/v2/customers', token, json=data).json()
+        except requests.HTTPError as error:
+            if error.response.status_code != 409:
+                raise
+            # Покупатель уже есть в магазине, но не попал в индекс: находим его по email
+            customers = self.request(
+                'GET',
+                '/v2/customers',
+                token,
+                params={'filter': f"eq(email,{data['data']['email']})"}
+            ).json()
+            if not customers['data']:
+                raise
+            customer = self.request(
+                'PUT',
+                f"/v2/customers/{customers['data'][0]['id']}",
+                token,
+                json=data
+            ).json()
+        DB.hset(CUSTOMER_INDEX_KEY, user_name, customer['data']['id'])
+        return customer
+
+    def backfill_customer_index(self, token=None):
+        # Разовое заполнение индекса покупателей: проходим по всем страницам /v2/customers
+        customers = self.iter_collection('/v2/customers', token)
+        for customers_batch in chunked(customers, PAGE_SIZE):
+            index = {
+                customer['name']: customer['id']
+                for customer in customers_batch
+                if customer.get('name')
+            }
+            if index:
+                DB.hset(CUSTOMER_INDEX_KEY, mapping=index)
+
+    def create_product(self, product_data: dict, token=None):
+        return self.request('POST', '/v2/products', token, json=product_data).json()
+
+    def get_pizzerias(self, token=None):
+        def fetch():
+            return list(self.iter_collection('/v2/flows/pizzeria/entries', token))
+
+        return CATALOG_CACHE.get_or_fetch(f"{self.base_url}:pizzerias", fetch)
+
+
+def configure_client(url, **kwargs):
+    # Позволяет подогнать размер пула под число потоков диспетчера
+    with CLIENTS_LOCK:
+        CLIENTS[url] = ElasticPathClient(url, **kwargs)
+        return CLIENTS[url]
+
+
+def get_client(url):
+    with CLIENTS_LOCK:
+        if url not in CLIENTS:
+            CLIENTS[url] = ElasticPathClient(url)
+        return CLIENTS[url]
+
+
+def get_auth_token(url, client_id, client_secret):
+    return get_client(url).get_auth_token(client_id, client_secret)
+
+
+def iter_collection(token, url, path, **kwargs):
+    return get_client(url).iter_collection(path, token, **kwargs)
+
+
+def get_products(token, url, id=None):
+    return get_client(url).get_products(id, token)
+
+
+def get_products_by_category_id(token, url, category_id):
+    return get_client(url).get_products_by_category_id(category_id, token)
+
+
+def get_file_link(token, url, id):
+    return get_client(url).get_file_link(id, token)
+
+
+def get_file_links(token, url, file_ids):
+    return get_client(url).get_file_links(file_ids, token)
+
+
+def get_product_image_links(token, url, products):
+    return get_client(url).get_product_image_links(products, token)
+
+
+def add_item_to_cart(token, url, cart_id, sku, quantity):
+    return get_client(url).add_item_to_cart(cart_id, sku, quantity, token)
+
+
+def delete_item(token, url, cart_id, item_id):
+    return get_client(url).delete_item(cart_id, item_id, token)
+
+
+def get_cart(token, url, cart_id, fresh=False):
+    return get_client(url).get_cart(cart_id, token, fresh)
 
 
 def create_or_update_customer(
@@ -162,73 +608,56 @@ def create_or_update_customer(
     latitude=None,
     longitude=None
 ):
-    headers = {
-        'Authorization': token,
-        'Content-Type': 'application/json'
-    }
-    data = {
-        'data': {
-            'type': 'customer',
-            'name': user_name,
-            'email': (user_email if user_email else f"{user_name}@email.com"),
-            'latitude': latitude,
-            'longitude': longitude,
-            'address': address
-        }
-    }
-    response = requests.get(f"{url}/v2/customers", headers=headers)
-    response.raise_for_status()
-    for customer in response.json()['data']:
-        if customer.get('name') == user_name:
-            response = requests.put(
-                f"{url}/v2/customers/{customer['id']}",
-                headers=headers,
-                json=data
-            )
-            response.raise_for_status()
-            return response.json()
-    response = requests.post(f"{url}/v2/customers", headers=headers, json=data)
-    response.raise_for_status()
-    return response.json()
+    return get_client(url).create_or_update_customer(
+        user_name,
+        user_email=user_email,
+        address=address,
+        latitude=latitude,
+        longitude=longitude,
+        token=token
+    )
+
+
+def backfill_customer_index(token, url):
+    return get_client(url).backfill_customer_index(token)
 
 
 def create_product(token, url, product_data: dict):
-    headers = {
-        "Authorization": token,
-        'Content-Type': 'application/json'
-    }
-    data = product_data
-    response = requests.post(f"{url}/v2/products", headers=headers, json=data)
-    response.raise_for_status()
-    return response.json()
+    return get_client(url).create_product(product_data, token)
 
 
 def get_pizzerias(token, url):
-    headers = {
-        "Authorization": token
-    }
-    response = requests.get(
-        f"{url}/v2/flows/pizzeria/entries",
-        headers=headers
-    )
-    response.raise_for_status()
-    return response.json().get('data')
+    return get_client(url).get_pizzerias(token)
+
+
+def normalize_address(address):
+    # "Москва, ул. Тверская,  д.7" и "москва улица тверская дом 7" дают один ключ
+    words = re.findall(r'[\w-]+', address.lower().replace('ё', 'е'))
+    return ' '.join(ADDRESS_ABBREVIATIONS.get(word, word) for word in words)
 
 
 def fetch_coordinates(address):
-    apikey = os.getenv('YANDEX_API_KEY')
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
-    response.raise_for_status()
-    found_places = response.json()['response']['GeoObjectCollection']['featureMember']
-
-    if not found_places:
-        return None, None
-
-    most_relevant = found_places[0]
-    lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
+    def fetch():
+        apikey = os.getenv('YANDEX_API_KEY')
+        with track(GEOCODER_LATENCY, GEOCODER_ERRORS):
+            response = GEOCODER_SESSION.get(GEOCODER_URL, params={
+                "geocode": address,
+                "apikey": apikey,
+                "format": "json",
+            }, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            response.raise_for_status()
+        found_places = response.json()['response']['GeoObjectCollection']['featureMember']
+
+        if not found_places:
+            return None, None
+
+        most_relevant = found_places[0]
+        lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
+        return lon, lat
+
+    lon, lat = GEOCODE_CACHE.get_or_fetch(
+        normalize_address(address),
+        fetch,
+        ttl=lambda coordinates: GEOCODE_CACHE.ttl if coordinates[0] else GEOCODE_NEGATIVE_TTL
+    )
     return lon, lat
@@ -0,0 +1,76 @@
+import pytest
+
+import shop
+
+
+class GeocoderStandIn:
+    # Заменяет сессию геокодера: отвечает заранее заданными координатами и считает запросы
+    def __init__(self, places):
+        self.places = places
+        self.requests = []
+
+    def get(self, url, params, timeout):
+        self.requests.append(params['geocode'])
+        position = self.places.get(params['geocode'])
+        members = [{'GeoObject': {'Point': {'pos': position}}}] if position else []
+        return GeocoderResponse({'response': {'GeoObjectCollection': {'featureMember': members}}})
+
+
+class GeocoderResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def geocoder(monkeypatch):
+    stand_in = GeocoderStandIn({
+        'Москва, ул. Тверская, д.7': '37.61 55.76',
+        'Москва, пр. Мира, 10': '37.63 55.78',
+    })
+    monkeypatch.setattr(shop, 'GEOCODER_SESSION', stand_in)
+    monkeypatch.setattr(shop, 'GEOCODE_CACHE', shop.TTLCache('geocode_test', ttl=60))
+    return stand_in
+
+
+@pytest.mark.parametrize('address, normalized', [
+    ('Москва, ул. Тверская,  д.7', 'москва улица тверская дом 7'),
+    ('москва улица тверская дом 7', 'москва улица тверская дом 7'),
+    ('Щёлковское ш., 2', 'щелковское шоссе 2'),
+    ('Ленинский пр-т, 30', 'ленинский проспект 30'),
+])
+def test_normalize_address(address, normalized):
+    assert shop.normalize_address(address) == normalized
+
+
+def test_normalize_address_keeps_ambiguous_abbreviation():
+    # "пр." - это и проспект, и проезд: такие адреса не должны получать один ключ
+    assert shop.normalize_address('пр. Мира') == 'пр мира'
+    assert shop.normalize_address('пр. Мира') != shop.normalize_address('проезд Мира')
+
+
+def test_fetch_coordinates_caches_by_normalized_address(geocoder):
+    assert shop.fetch_coordinates('Москва, ул. Тверская, д.7') == ('37.61', '55.76')
+    assert shop.fetch_coordinates('москва улица тверская дом 7') == ('37.61', '55.76')
+    assert geocoder.requests == ['Москва, ул. Тверская, д.7']
+    assert shop.GEOCODE_CACHE.hits == 1
+    assert shop.GEOCODE_CACHE.misses == 1
+
+
+def test_fetch_coordinates_caches_unknown_address(geocoder, monkeypatch):
+    ttls = []
+    set_cached = shop.GEOCODE_CACHE.set
+    monkeypatch.setattr(
+        shop.GEOCODE_CACHE,
+        'set',
+        lambda key, value, ttl=None: ttls.append(ttl) or set_cached(key, value, ttl)
+    )
+    assert shop.fetch_coordinates('нигде') == (None, None)
+    assert shop.fetch_coordinates('Нигде') == (None, None)
+    assert geocoder.requests == ['нигде']
+    assert ttls == [shop.GEOCODE_NEGATIVE_TTL]
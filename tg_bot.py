@@ -1,56 +1,137 @@
+import hashlib
+import json
+import logging
 import os
+import threading
 
+from collections import OrderedDict
+from functools import partial
 from textwrap import dedent
 
 import redis
 
 from dotenv import load_dotenv
-from geopy.distance import distance
 from more_itertools import chunked
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, Update
+from telegram.error import BadRequest, TimedOut
 from telegram.ext import Filters, Updater, CallbackContext
 from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, PreCheckoutQueryHandler
 
+from delivery import PICKUP_ONLY, get_pizzeria_index, price_delivery
+from metrics import HANDLER_ERRORS, HANDLER_LATENCY, start_metrics_server, track
+from scheduler import DelayedJobs
 from shop import (
-    get_products, get_auth_token, get_file_link, add_item_to_cart,
+    get_products, get_file_link, add_item_to_cart,
     get_cart, delete_item, create_or_update_customer,
-    fetch_coordinates, get_pizzerias
+    fetch_coordinates, set_db, configure_client, backfill_customer_index,
+    FILE_LINK_WORKERS, CUSTOMER_INDEX_KEY, StoreTokenManager
 )
+from tg_sender import (
+    OutboundQueue, QueuedBot,
+    PRIORITY_ORDER, PRIORITY_REPLY, PRIORITY_FOLLOW_UP, PRIORITY_COSMETIC
+)
+
 
+logger = logging.getLogger(__name__)
 
 DB = None
 
-def start(update: Update, context: CallbackContext):
-    products = get_products(
-        context.bot_data['store_token'],
-        context.bot_data['base_url']
-    )
+# Клавиатуры каталога строятся один раз на каждую версию каталога и размер страницы
+PRODUCT_PAGE_SIZES = (5, 8, 10)
+DEFAULT_PRODUCT_PAGE_SIZE = 8
+PRODUCT_KEYBOARDS = OrderedDict()
+PRODUCT_KEYBOARDS_VERSIONS = 3
+PRODUCT_KEYBOARDS_LOCK = threading.Lock()
+CATALOG_VERSION = (None, None)
+
+# Данные заказа хранятся в Redis по каждому чату, а не в общем bot_data
+SESSION_TTL = 24 * 3600
+# Задержка отправки follow-up сообщения в секундах
+FOLLOW_UP_DELAY = 3600
+
+
+def get_store_token(context: CallbackContext):
+    return context.bot_data['store_tokens'].get()
+
+
+def get_outbound(context: CallbackContext, priority=PRIORITY_REPLY):
+    # Сообщения не отправляются из обработчика напрямую, а ставятся в общую очередь
+    return QueuedBot(context.bot_data['outbound'], priority)
 
-    product_keyboards = list(chunked([
+
+def build_product_keyboards(products, version):
+    product_buttons = [
         [InlineKeyboardButton(
             f"{product['name']} - {product['price'][0]['amount']}р.",
             callback_data=product['id']
-        )] for product in products['data']
-    ], context.bot_data['pagesize']))
-
-    context.bot_data['product_keyboards'] = product_keyboards
-
-    keyboard = (
-        product_keyboards[0] +
-        ([[InlineKeyboardButton(
-            'Еще',
-            callback_data=min(len(product_keyboards) - 1, 1)
-        )]] if (len(products['data']) > context.bot_data['pagesize']) else []) +
-        [[InlineKeyboardButton('Моя корзина', callback_data='show_cart')]]
+        )] for product in products
+    ]
+    keyboards = {}
+    for pagesize in PRODUCT_PAGE_SIZES:
+        pages = list(chunked(product_buttons, pagesize)) or [[]]
+        keyboards[pagesize] = tuple(
+            InlineKeyboardMarkup(
+                page +
+                ([[InlineKeyboardButton(
+                    'Еще',
+                    callback_data=f"page:{version}:{pagesize}:{(page_number + 1) % len(pages)}"
+                )]] if len(pages) > 1 else []) +
+                [[InlineKeyboardButton('Моя корзина', callback_data='show_cart')]]
+            )
+            for page_number, page in enumerate(pages)
+        )
+    return keyboards
+
+
+def get_catalog_version(context: CallbackContext):
+    # Каталог приходит из кэша; клавиатуры пересобираются, только если из кэша
+    # пришел новый список товаров с другим содержимым
+    global CATALOG_VERSION
+    products = get_products(
+        get_store_token(context),
+        context.bot_data['base_url']
+    )['data']
+    with PRODUCT_KEYBOARDS_LOCK:
+        cached_products, version = CATALOG_VERSION
+        if cached_products is products:
+            return version
+        version = hashlib.sha1(json.dumps(
+            [(product['id'], product['name'], product['price']) for product in products],
+            sort_keys=True
+        ).encode('utf-8')).hexdigest()[:8]
+        if version not in PRODUCT_KEYBOARDS:
+            PRODUCT_KEYBOARDS[version] = build_product_keyboards(products, version)
+            while len(PRODUCT_KEYBOARDS) > PRODUCT_KEYBOARDS_VERSIONS:
+                PRODUCT_KEYBOARDS.popitem(last=False)
+        CATALOG_VERSION = (products, version)
+        return version
+
+
+def get_product_keyboard(context: CallbackContext, page_number=0, version=None, pagesize=None):
+    pagesize = pagesize or context.bot_data['pagesize']
+    keyboards = PRODUCT_KEYBOARDS.get(version)
+    if not keyboards:
+        # Кнопка от устаревшей версии каталога: показываем актуальную
+        keyboards = PRODUCT_KEYBOARDS[get_catalog_version(context)]
+    # Размер страницы, для которого клавиатуры не строились, заменяем размером по умолчанию
+    pages = (
+        keyboards.get(pagesize)
+        or keyboards.get(context.bot_data['pagesize'])
+        or keyboards[DEFAULT_PRODUCT_PAGE_SIZE]
     )
-    context.bot.send_message(
+    return pages[page_number % len(pages)]
+
+
+def start(update: Update, context: CallbackContext):
+    version = get_catalog_version(context)
+    get_outbound(context).send_message(
         chat_id=update.effective_chat.id,
         text='Приветствуем в нашей пиццерии. Хотите заказать пиццу?',
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=get_product_keyboard(context, version=version)
     )
     message = update.effective_message
-    context.bot.delete_message(
+    get_outbound(context, PRIORITY_COSMETIC).delete_message(
         chat_id=message.chat_id,
         message_id=message.message_id
     )
@@ -61,31 +142,19 @@ def handle_product(update: Update, context: CallbackContext):
     query = update.callback_query
     if query.data == 'show_cart':
         return show_cart(update, context)
-    if len(query.data) <= 2:
-        page_number = int(query.data)
-        keyboard = (
-            context.bot_data['product_keyboards'][page_number] +
-            [[InlineKeyboardButton(
-                'Еще',
-                callback_data=(
-                    page_number + 1
-                    if page_number < len(context.bot_data['product_keyboards']) - 1
-                    else 0
-                )
-            )]] +
-            [[InlineKeyboardButton('Моя корзина', callback_data='show_cart')]]
-        )
+    if query.data.startswith('page:'):
+        _, version, pagesize, page_number = query.data.split(':')
         message = update.effective_message
-        context.bot.edit_message_text(
+        get_outbound(context).edit_message_text(
             chat_id=message.chat.id,
             message_id=message.message_id,
             text=message.text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=get_product_keyboard(context, int(page_number), version, int(pagesize))
         )
         return 'PRODUCT_CHOICE'
 
     product = get_products(
-        context.bot_data['store_token'],
+        get_store_token(context),
         context.bot_data['base_url'],
         query.data
     )['data']
@@ -104,30 +173,97 @@ def handle_product(update: Update, context: CallbackContext):
     ]
     image_meta = product.get('relationships', {0: 0}).get('main_image')
     if image_meta:
-        image = get_file_link(
-            context.bot_data['store_token'],
-            context.bot_data['base_url'],
-            image_meta['data']['id']
-        )
-        context.bot.send_photo(
-            chat_id=query.message.chat_id,
-            photo=image,
+        send_product_photo(
+            context,
+            query.message.chat_id,
+            product['id'],
+            image_meta['data']['id'],
             caption=text,
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     else:
-        context.bot.send_message(
+        get_outbound(context).send_message(
             chat_id=query.message.chat_id,
             text=text,
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
-    context.bot.delete_message(
+    get_outbound(context, PRIORITY_COSMETIC).delete_message(
         chat_id=query.message.chat_id,
         message_id=query.message.message_id
     )
     return 'HANDLE_MENU'
 
 
+def get_telegram_file_id(product_id, image_id):
+    db = get_db_connection()
+    # Если у товара сменилась картинка, старый file_id больше не нужен
+    previous_image_id = db.get(f"tg_product_image:{product_id}")
+    if previous_image_id and previous_image_id.decode('UTF-8') != image_id:
+        db.delete(f"tg_file:{previous_image_id.decode('UTF-8')}")
+        db.delete(f"tg_product_image:{product_id}")
+    file_id = db.get(f"tg_file:{image_id}")
+    return file_id.decode('UTF-8') if file_id else None
+
+
+def remember_telegram_file_id(product_id, image_id, message):
+    db = get_db_connection()
+    db.set(f"tg_file:{image_id}", message.photo[-1].file_id)
+    db.set(f"tg_product_image:{product_id}", image_id)
+
+
+def send_product_photo(context: CallbackContext, chat_id, product_id, image_id, **kwargs):
+    # Повторно отправляем уже загруженную в Telegram картинку по ее file_id,
+    # чтобы Telegram не скачивал ее заново с CDN магазина
+    def send_by_link():
+        image = get_file_link(
+            get_store_token(context),
+            context.bot_data['base_url'],
+            image_id
+        )
+        get_outbound(context).send_photo(
+            chat_id=chat_id,
+            photo=image,
+            on_success=lambda message: remember_telegram_file_id(product_id, image_id, message),
+            **kwargs
+        )
+
+    def forget_file_id(error):
+        if not isinstance(error, BadRequest):
+            return
+        get_db_connection().delete(f"tg_file:{image_id}")
+        send_by_link()
+
+    file_id = get_telegram_file_id(product_id, image_id)
+    if not file_id:
+        send_by_link()
+        return
+    get_outbound(context).send_photo(
+        chat_id=chat_id,
+        photo=file_id,
+        on_error=forget_file_id,
+        **kwargs
+    )
+
+
+def prewarm_product_photos(bot, store_token, base_url, chat_id):
+    # Загружаем в Telegram все картинки каталога заранее, отправляя их в служебный чат
+    products = get_products(store_token, base_url)['data']
+    for product in products:
+        image_meta = product.get('relationships', {}).get('main_image')
+        if not image_meta:
+            continue
+        image_id = image_meta['data']['id']
+        if get_telegram_file_id(product['id'], image_id):
+            continue
+        message = bot.send_photo(
+            chat_id=chat_id,
+            photo=get_file_link(store_token, base_url, image_id),
+            disable_notification=True
+        )
+        remember_telegram_file_id(product['id'], image_id, message)
+        bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+
+
 def handle_menu(update: Update, context: CallbackContext):
     query = update.callback_query
     if query.data == 'back' or query.data == 'continue':
@@ -138,7 +274,7 @@ def handle_menu(update: Update, context: CallbackContext):
         return show_cart(update, context)
     sku = query.data
     cart = add_item_to_cart(
-        context.bot_data['store_token'],
+        get_store_token(context),
         context.bot_data['base_url'],
         cart_id=update.effective_chat.id,
         sku=sku,
@@ -151,7 +287,7 @@ def handle_menu(update: Update, context: CallbackContext):
 
 def show_cart(update: Update, context: CallbackContext):
     cart = get_cart(
-        context.bot_data['store_token'],
+        get_store_token(context),
         context.bot_data['base_url'],
         update.effective_chat.id
     )
@@ -162,12 +298,12 @@ def show_cart(update: Update, context: CallbackContext):
     keyboard.append([InlineKeyboardButton('Продолжить покупки', callback_data='continue')])
     if cart['total_price']:
         keyboard.append([InlineKeyboardButton('Перейти к оформлению заказа', callback_data='pay')])
-    context.bot.send_message(
+    get_outbound(context).send_message(
         chat_id=update.effective_chat.id,
         text=f"Сейчас у вас в корзине:\n{make_cart_description(cart)}",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    context.bot.delete_message(
+    get_outbound(context, PRIORITY_COSMETIC).delete_message(
         chat_id=update.callback_query.message.chat_id,
         message_id=update.callback_query.message.message_id
     )
@@ -181,7 +317,7 @@ def handle_cart(update: Update, context: CallbackContext):
     elif query.data == 'pay':
         return request_address(update, context)
     delete_item(
-        context.bot_data['store_token'],
+        get_store_token(context),
         context.bot_data['base_url'],
         update.effective_chat.id,
         query.data
@@ -190,12 +326,12 @@ def handle_cart(update: Update, context: CallbackContext):
 
 
 def request_address(update: Update, context: CallbackContext):
-    context.bot.send_message(
+    get_outbound(context).send_message(
         chat_id=update.effective_chat.id,
         text='Пожалуйста, напишите свой адрес для доставки или пришлите геолокацию'
     )
     message = update.effective_message
-    context.bot.delete_message(
+    get_outbound(context, PRIORITY_COSMETIC).delete_message(
         chat_id=message.chat_id,
         message_id=message.message_id
     )
@@ -210,67 +346,48 @@ def get_coordinates(update: Update, context: CallbackContext):
     else:
         lon, lat = fetch_coordinates(user_reply.text)
     if not lon:
-        context.bot.send_message(
+        get_outbound(context).send_message(
             chat_id=update.effective_chat.id,
             text='Не удалось определить ваше местоположение. Пожалуйста, введите корректный адрес'
         )
         return 'WAITING_LOCATION'
 
     create_or_update_customer(
-        context.bot_data['store_token'],
+        get_store_token(context),
         context.bot_data['base_url'],
         str(update.effective_chat.id),
         latitude=lat,
         longitude=lon,
         address=user_reply.text
     )
-    context.bot_data['longitude'] = lon
-    context.bot_data['latitude'] = lat
-    pizzerias = get_pizzerias(
-        context.bot_data['store_token'],
+    context.chat_data['longitude'] = lon
+    context.chat_data['latitude'] = lat
+    pizzeria_index = get_pizzeria_index(
+        get_store_token(context),
         context.bot_data['base_url']
         )
-    closest_pizzeria = min(pizzerias, key=lambda x: distance(
-        (lat, lon),
-        (x.get('latitude'), x.get('longitude'))
-    ))
-    range = distance(
-        (lat, lon),
-        (closest_pizzeria['latitude'], closest_pizzeria['longitude'])
-    )
-    text = f"Ближайшая к вам пиццерия находится по адресу {closest_pizzeria['address']} на расстоянии {round(range.km, 1)} км"
-    if range.km <= 0.5:
-        text += '\nОтсюда можем доставить вам пиццу бесплатно. Или вы можете забрать ее самостоятельно'
-        keyboard = [
-            [InlineKeyboardButton('Самовывоз', callback_data='self_pickup')],
-            [InlineKeyboardButton(
-                'Доставка',
-                callback_data=f"{closest_pizzeria['courier_tg']}/0"
-            )]
-        ]
-    elif range.km <= 5:
-        text += '\nСтоимость доставки до вас от ближайшей пиццерии - 100 рублей'
-        keyboard = [
-            [InlineKeyboardButton('Самовывоз', callback_data='self_pickup')],
-            [InlineKeyboardButton('Доставка', callback_data=f"{closest_pizzeria['courier_tg']}/100")]
-        ]
-    elif range.km <= 20:
-        text += '\nСтоимость доставки до вас от ближайшей пиццерии - 300 рублей'
-        keyboard = [
-            [InlineKeyboardButton('Самовывоз', callback_data='self_pickup')],
-            [InlineKeyboardButton('Доставка', callback_data=f"{closest_pizzeria['courier_tg']}/300")]
-        ]
-    else:
+    closest_pizzeria, range_km, delivery_cost = price_delivery(pizzeria_index, lat, lon)
+    text = f"Ближайшая к вам пиццерия находится по адресу {closest_pizzeria['address']} на расстоянии {round(range_km, 1)} км"
+    keyboard = [
+        [InlineKeyboardButton('Самовывоз', callback_data='self_pickup')]
+    ]
+    if delivery_cost == PICKUP_ONLY:
         text += '\nК сожалению, до вашего адреса пиццу мы доставить не сможем.\nНо вы можете забрать ее самостоятельно'
-        keyboard = [
-            [InlineKeyboardButton('Самовывоз', callback_data='self_pickup')]
-        ]
-    context.bot.send_location(
+    else:
+        if delivery_cost:
+            text += f'\nСтоимость доставки до вас от ближайшей пиццерии - {delivery_cost} рублей'
+        else:
+            text += '\nОтсюда можем доставить вам пиццу бесплатно. Или вы можете забрать ее самостоятельно'
+        keyboard.append([InlineKeyboardButton(
+            'Доставка',
+            callback_data=f"{closest_pizzeria['courier_tg']}/{delivery_cost}"
+        )])
+    get_outbound(context).send_location(
         chat_id=update.effective_chat.id,
         latitude=closest_pizzeria['latitude'],
         longitude=closest_pizzeria['longitude']
     )
-    context.bot.send_message(
+    get_outbound(context).send_message(
             chat_id=update.effective_chat.id,
             text=text,
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -281,12 +398,12 @@ def get_coordinates(update: Update, context: CallbackContext):
 def order_delivery(update: Update, context: CallbackContext):
     query = update.callback_query
     if query.data == 'self_pickup':
-        context.bot.send_message(
+        get_outbound(context).send_message(
             chat_id=update.effective_chat.id,
             text='Отлично. Ждем вас в нашей пиццерии'
         )
         message = update.effective_message
-        context.bot.delete_message(
+        get_outbound(context, PRIORITY_COSMETIC).delete_message(
             chat_id=message.chat_id,
             message_id=message.message_id
         )
@@ -294,12 +411,13 @@ def order_delivery(update: Update, context: CallbackContext):
 
     # Сохраняем телеграм-чат курьера для последующей отправки ему уведомления в случае успешной оплаты заказа
     # и стоимость доставки
-    context.bot_data['courier_tg'], context.bot_data['delivery_cost'] = map(int, query.data.split('/'))
+    context.chat_data['courier_tg'], context.chat_data['delivery_cost'] = map(int, query.data.split('/'))
 
-    context.bot_data['cart'] = get_cart(
-        context.bot_data['store_token'],
+    context.chat_data['cart'] = get_cart(
+        get_store_token(context),
         context.bot_data['base_url'],
-        update.effective_chat.id
+        update.effective_chat.id,
+        fresh=True
     )
 
     keyboard = [
@@ -307,18 +425,18 @@ def order_delivery(update: Update, context: CallbackContext):
         [InlineKeyboardButton('Картой онлайн', callback_data='card')]
     ]
 
-    context.bot.send_message(
+    get_outbound(context).send_message(
             chat_id=update.effective_chat.id,
             text=dedent(f"""
-            Итак, ваш заказ:\n{make_cart_description(context.bot_data['cart'])}
-            Стоимость доставки: {context.bot_data['delivery_cost']}
-            Общая стоимость заказа: {context.bot_data['cart']['total_price'] + context.bot_data['delivery_cost']}
+            Итак, ваш заказ:\n{make_cart_description(context.chat_data['cart'])}
+            Стоимость доставки: {context.chat_data['delivery_cost']}
+            Общая стоимость заказа: {context.chat_data['cart']['total_price'] + context.chat_data['delivery_cost']}
             Хотите оплатить картой онлайн или наличными курьеру?"""),
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
     
     message = update.effective_message
-    context.bot.delete_message(
+    get_outbound(context, PRIORITY_COSMETIC).delete_message(
         chat_id=message.chat_id,
         message_id=message.message_id
     )
@@ -328,65 +446,82 @@ def order_delivery(update: Update, context: CallbackContext):
 
 def choose_payment_mode(update: Update, context: CallbackContext):
     if update.callback_query.data == 'cash':
-        context.bot_data['payment'] = 'cash'
+        context.chat_data['payment'] = 'cash'
         message = update.effective_message
-        context.bot.delete_message(
+        get_outbound(context, PRIORITY_COSMETIC).delete_message(
             chat_id=message.chat_id,
             message_id=message.message_id
         )
         return send_final_messages(update, context)
 
-    context.bot.send_invoice(
+    context.chat_data['payment'] = 'card'
+    get_outbound(context, PRIORITY_ORDER).send_invoice(
         chat_id=update.effective_chat.id,
         title='Ваш заказ',
-        description=f"Общая стоимость заказа {context.bot_data['cart']['total_price']} р.",
+        description=f"Общая стоимость заказа {context.chat_data['cart']['total_price']} р.",
         provider_token=os.getenv('PAYMENT_TOKEN'),
         currency='RUB',
-        prices=[LabeledPrice('Общая сумма', (context.bot_data['cart']['total_price'] + context.bot_data['delivery_cost']) * 100)],
+        prices=[LabeledPrice('Общая сумма', (context.chat_data['cart']['total_price'] + context.chat_data['delivery_cost']) * 100)],
         payload="Test_payment"
     )
 
 
 def send_final_messages(update: Update, context: CallbackContext):
 
-    context.bot.send_message(
+    get_outbound(context).send_message(
         chat_id=update.effective_chat.id,
         text='Передали заказ в доставку. Ожидайте курьера в течение часа'
     )
 
     # Отправка заказа курьеру для доставки
 
-    if context.bot_data['payment'] == 'cash':
+    if context.chat_data.get('payment') == 'cash':
         payment_mode_text= 'Оплата наличными на месте'
     else:
         payment_mode_text = 'Заказ оплачен картой'
 
-    context.bot.send_message(
-        chat_id=context.bot_data['courier_tg'],
-        text=dedent(f"""Заказ для доставки:\n{make_cart_description(context.bot_data.get('cart'))} р.
-                    Общая стоимость заказа: {context.bot_data['cart']['total_price'] + context.bot_data['delivery_cost']} р.
+    get_outbound(context, PRIORITY_ORDER).send_message(
+        chat_id=context.chat_data['courier_tg'],
+        text=dedent(f"""Заказ для доставки:\n{make_cart_description(context.chat_data.get('cart'))} р.
+                    Общая стоимость заказа: {context.chat_data['cart']['total_price'] + context.chat_data['delivery_cost']} р.
                     {payment_mode_text}""")
     )
-    context.bot.send_location(
-        chat_id=context.bot_data['courier_tg'],
-        latitude=context.bot_data['latitude'],
-        longitude=context.bot_data['longitude']
+    get_outbound(context, PRIORITY_ORDER).send_location(
+        chat_id=context.chat_data['courier_tg'],
+        latitude=context.chat_data['latitude'],
+        longitude=context.chat_data['longitude']
     )
 
-    # Отправка follow-up сообщения
-    context.job_queue.run_once(
-        send_follow_up_message,
-        3600,  # Задержка отправки follow-up сообщения в секундах
-        context=update.effective_chat.id
+    # Отправка follow-up сообщения; задача хранится в Redis и переживает перезапуск бота
+    context.bot_data['delayed_jobs'].schedule(
+        'follow_up',
+        FOLLOW_UP_DELAY,
+        job_id=f"follow_up:{update.effective_chat.id}",
+        chat_id=update.effective_chat.id
+    )
+    # Заказ оформлен: данные сессии не должны попасть в следующий заказ
+    context.chat_data.clear()
+    return 'START'
+
+
+def send_follow_up_message(outbound, chat_id, ack, fail):
+    # Задача подтверждается только после отправки: если процесс перезапустится
+    # раньше, напоминание отправит другой процесс
+    QueuedBot(outbound, PRIORITY_FOLLOW_UP).send_message(
+        chat_id=chat_id,
+        text='Приятного аппетита, надеемся, вам понравилась пицца.\nЕсли вы до сих пор ее не получили, то...',
+        on_success=lambda message: ack(),
+        on_error=partial(fail_follow_up, ack, fail)
     )
-    return 'FINISH'
 
 
-def send_follow_up_message(context: CallbackContext):
-    context.bot.send_message(
-        chat_id=context.job.context,
-        text='Приятного аппетита, надеемся, вам понравилась пицца.\nЕсли вы до сих пор ее не получили, то...'
-    )
+def fail_follow_up(ack, fail, error):
+    # После таймаута напоминание могло уже дойти: повтор отправил бы его дважды
+    if isinstance(error, TimedOut):
+        logger.warning('Напоминание могло не дойти: %s', error)
+        ack()
+    else:
+        fail(error)
 
 
 def get_db_connection():
@@ -413,8 +548,45 @@ def make_cart_description(cart):
     return text
 
 
+def load_session(chat_id):
+    # Состояние и данные заказа читаются за один запрос к Redis
+    with get_db_connection().pipeline(transaction=False) as pipe:
+        pipe.get(chat_id)
+        pipe.hgetall(f"session:{chat_id}")
+        state, session = pipe.execute()
+    return (
+        state.decode('UTF-8') if state else None,
+        {key.decode('UTF-8'): json.loads(value) for key, value in session.items()}
+    )
+
+
+def save_session(chat_id, state, session):
+    # Сессия перезаписывается целиком, чтобы удаленные из chat_data поля не оставались
+    # в Redis; пустая сессия просто удаляется
+    with get_db_connection().pipeline() as pipe:
+        if state:
+            pipe.set(chat_id, state)
+        pipe.delete(f"session:{chat_id}")
+        if session:
+            pipe.hset(
+                f"session:{chat_id}",
+                mapping={key: json.dumps(value) for key, value in session.items()}
+            )
+            pipe.expire(f"session:{chat_id}", SESSION_TTL)
+        pipe.execute()
+
+
+def handle_successful_payment(update: Update, context: CallbackContext):
+    chat_id = update.effective_chat.id
+    _, session = load_session(chat_id)
+    context.chat_data.clear()
+    context.chat_data.update(session)
+    with track(HANDLER_LATENCY, HANDLER_ERRORS, bot='telegram', state='SUCCESSFUL_PAYMENT'):
+        next_state = send_final_messages(update, context)
+    save_session(chat_id, next_state, context.chat_data)
+
+
 def user_input_handler(update: Update, context: CallbackContext):
-    db = get_db_connection()
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -424,11 +596,6 @@ def user_input_handler(update: Update, context: CallbackContext):
     else:
         return
 
-    if user_reply == '/start':
-        user_state = 'START'
-    else:
-        user_state = db.get(chat_id).decode('UTF-8')
-
     states_function = {
         'START': start,
         'PRODUCT_CHOICE': handle_product,
@@ -439,10 +606,17 @@ def user_input_handler(update: Update, context: CallbackContext):
         'AWAITING_PAYMENT_MODE': choose_payment_mode
     }
 
-    state_handler = states_function[user_state]
+    user_state, session = load_session(chat_id)
+    # Новый чат или истекшее состояние начинается заново, как в webhook.handle_users_reply
+    if user_reply == '/start' or user_state not in states_function:
+        user_state = 'START'
+    context.chat_data.clear()
+    context.chat_data.update(session)
 
-    next_state = state_handler(update, context)
-    db.set(chat_id, next_state)
+    with track(HANDLER_LATENCY, HANDLER_ERRORS, bot='telegram', state=user_state):
+        state_handler = states_function[user_state]
+        next_state = state_handler(update, context)
+    save_session(chat_id, next_state, context.chat_data)
 
 
 def pre_checkout(update: Update, context: CallbackContext):
@@ -458,47 +632,62 @@ def pre_checkout(update: Update, context: CallbackContext):
         )
 
 
-def refresh_token(context: CallbackContext):
-    context.bot_data['store_token'], context.bot_data['token_lifetime'] = get_auth_token(
-        context.bot_data['base_url'],
-        context.bot_data['client_id'],
-        context.bot_data['client_secret']
+def setup_dispatcher(dispatcher):
+    # Общая настройка для запуска через long polling (main) и через вебхук (tg_webhook.py)
+    dispatcher.bot_data['base_url'] = 'https://api.moltin.com'
+    dispatcher.bot_data['pagesize'] = DEFAULT_PRODUCT_PAGE_SIZE  # Размер страницы списка пицц
+    set_db(get_db_connection())
+    # Токен магазина хранится в Redis и обновляется заранее, общий для всех процессов
+    dispatcher.bot_data['store_tokens'] = StoreTokenManager(
+        get_db_connection(),
+        dispatcher.bot_data['base_url'],
+        os.getenv('CLIENT_ID'),
+        os.getenv('CLIENT_SECRET')
+    )
+    # Каждому потоку диспетчера и загрузчику картинок нужно свое соединение в пуле
+    configure_client(
+        dispatcher.bot_data['base_url'],
+        token_manager=dispatcher.bot_data['store_tokens'],
+        pool_size=max(dispatcher.workers, 1) + FILE_LINK_WORKERS + 1
+    )
+    dispatcher.bot_data['outbound'] = OutboundQueue(dispatcher.bot, db=get_db_connection()).start()
+    # Отложенные задачи забирает из Redis любой запущенный процесс бота
+    dispatcher.bot_data['delayed_jobs'] = DelayedJobs(get_db_connection())
+    dispatcher.bot_data['delayed_jobs'].register(
+        'follow_up',
+        partial(send_follow_up_message, dispatcher.bot_data['outbound']),
+        manual_ack=True
     )
-    # Каждый раз в случае успешного получения токена убираем предыдущее запланированное задание
-    # и создаем новое с новым периодом обновленя
-    context.bot_data['refreshing'].schedule_removal()
-    context.bot_data['refreshing'] = context.job_queue.run_repeating(
-        refresh_token,
-        interval=int(context.bot_data['token_lifetime']*0.9)
+    dispatcher.bot_data['delayed_jobs'].start()
+    store_token = dispatcher.bot_data['store_tokens'].get()
+    if not get_db_connection().exists(CUSTOMER_INDEX_KEY):
+        backfill_customer_index(store_token, dispatcher.bot_data['base_url'])
+    prewarm_chat_id = os.getenv('TG_PREWARM_CHAT_ID')
+    if prewarm_chat_id:
+        prewarm_product_photos(
+            dispatcher.bot,
+            store_token,
+            dispatcher.bot_data['base_url'],
+            prewarm_chat_id
         )
+    dispatcher.add_handler(CallbackQueryHandler(user_input_handler))
+    dispatcher.add_handler(MessageHandler(Filters.successful_payment, handle_successful_payment))
+    dispatcher.add_handler(MessageHandler(Filters.text, user_input_handler))
+    dispatcher.add_handler(CommandHandler('start', user_input_handler))
+    dispatcher.add_handler(MessageHandler(Filters.location, user_input_handler))
+    dispatcher.add_handler(PreCheckoutQueryHandler(pre_checkout))
 
 
 def main():
     load_dotenv()
     tg_token = os.getenv('TG_TOKEN')
     updater = Updater(tg_token)
-    updater.dispatcher.bot_data['base_url'] = 'https://api.moltin.com'
-    updater.dispatcher.bot_data['client_id'] = os.getenv('CLIENT_ID')
-    updater.dispatcher.bot_data['client_secret'] = os.getenv('CLIENT_SECRET')
-    updater.dispatcher.bot_data['pagesize'] = 8  # Размер страницы списка пицц
-    # В начале создаем задание по регулярному обновлению токена с дефолтным периодом 120 секунд
-    updater.dispatcher.bot_data['refreshing'] = updater.job_queue.run_repeating(
-        refresh_token,
-        interval=120,
-        first=1
-        )
-
+    setup_dispatcher(updater.dispatcher)
+    start_metrics_server()
     bot_commands = [
         ('start', 'Начать диалог')
     ]
     updater.bot.set_my_commands(bot_commands)
-    dispatcher = updater.dispatcher
-    dispatcher.add_handler(CallbackQueryHandler(user_input_handler))
-    dispatcher.add_handler(MessageHandler(Filters.successful_payment, send_final_messages))
-    dispatcher.add_handler(MessageHandler(Filters.text, user_input_handler))
-    dispatcher.add_handler(CommandHandler('start', user_input_handler))
-    dispatcher.add_handler(MessageHandler(Filters.location, user_input_handler))
-    dispatcher.add_handler(PreCheckoutQueryHandler(pre_checkout))
     updater.start_polling()
     updater.idle()
 
@@ -0,0 +1,205 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut, Unauthorized
+
+from metrics import SEND_ERRORS, SEND_LATENCY, track
+from ratelimit import BucketRegistry, RedisTokenBucket, TokenBucket
+
+
+logger = logging.getLogger(__name__)
+
+# Классы приоритета: чем меньше число, тем раньше уходит сообщение
+PRIORITY_ORDER = 0  # заказы курьерам и счета на оплату
+PRIORITY_REPLY = 1  # ответы пользователю в диалоге
+PRIORITY_FOLLOW_UP = 2  # отложенные напоминания
+PRIORITY_COSMETIC = 3  # удаление старых сообщений
+
+MAX_ATTEMPTS = 3
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих запросов к Telegram. Обработчики только ставят запрос в очередь,
+    а отправляют его фоновые потоки с учетом общего лимита бота и лимита на каждый чат.
+    Если передано соединение с Redis, общий лимит делят все процессы бота.
+    Запросы одного чата уходят по одному и в порядке приоритета, а внутри одного
+    приоритета - в порядке постановки. RetryAfter приостанавливает все отправки.
+
+    Использование:
+
+        outbound = OutboundQueue(bot, db=db).start()
+        outbound.put('send_message', chat_id=chat_id, text='Привет')
+    """
+
+    def __init__(
+        self,
+        bot,
+        workers=8,
+        global_rate=None,
+        chat_rate=None,
+        chat_burst=3,
+        db=None
+    ):
+        global_rate = global_rate or int(os.getenv('TG_GLOBAL_RATE', 30))
+        chat_rate = chat_rate or float(os.getenv('TG_CHAT_RATE', 1))
+        self.bot = bot
+        self.workers = workers
+        if db is not None:
+            self.global_bucket = RedisTokenBucket(db, 'tg_global_rate', global_rate, global_rate)
+        else:
+            self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = BucketRegistry(chat_rate, chat_burst)
+        # У каждого чата своя очередь; в ready лежат первые запросы свободных чатов,
+        # а в delayed - чаты, ждущие своего лимита, поэтому выбор следующего запроса
+        # не перебирает запросы занятых чатов
+        self.chat_queues = {}
+        self.ready = []
+        self.delayed = []
+        self.size = 0
+        self.counter = itertools.count()
+        self.busy_chats = set()
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def start(self):
+        for number in range(self.workers - len(self.threads)):
+            thread = threading.Thread(
+                target=self.work,
+                name=f'tg_sender_{number}',
+                daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def put(self, method, chat_id, priority=PRIORITY_REPLY, on_success=None, on_error=None, **kwargs):
+        # on_success получает ответ Telegram, on_error - исключение; оба вызываются в потоке отправки
+        task = {
+            'method': method,
+            'chat_id': chat_id,
+            'kwargs': kwargs,
+            'on_success': on_success,
+            'on_error': on_error,
+            'attempt': 0
+        }
+        self._push(priority, next(self.counter), task)
+
+    def _push(self, priority, number, task):
+        with self.condition:
+            chat_queue = self.chat_queues.setdefault(task['chat_id'], [])
+            heapq.heappush(chat_queue, (priority, number, task))
+            self.size += 1
+            if chat_queue[0][1] == number:
+                self._mark_ready(task['chat_id'])
+            self.condition.notify()
+
+    def _mark_ready(self, chat_id):
+        # Устаревшие записи в ready (чат занят или первый запрос сменился) пропускаются в take
+        chat_queue = self.chat_queues.get(chat_id)
+        if chat_queue and chat_id not in self.busy_chats:
+            priority, number, _ = chat_queue[0]
+            heapq.heappush(self.ready, (priority, number, chat_id))
+
+    def take(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, chat_id = heapq.heappop(self.delayed)
+                    self._mark_ready(chat_id)
+                while self.ready:
+                    priority, number, chat_id = heapq.heappop(self.ready)
+                    chat_queue = self.chat_queues.get(chat_id)
+                    # Пока у чата есть запрос в отправке, следующие ждут, чтобы не нарушить порядок
+                    if chat_id in self.busy_chats or not chat_queue or chat_queue[0][1] != number:
+                        continue
+                    bucket = self.chat_buckets.get(chat_id)
+                    if not bucket.try_acquire():
+                        heapq.heappush(self.delayed, (now + bucket.delay(), chat_id))
+                        continue
+                    entry = heapq.heappop(chat_queue)
+                    if not chat_queue:
+                        del self.chat_queues[chat_id]
+                    self.size -= 1
+                    self.busy_chats.add(chat_id)
+                    return entry
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def pending(self):
+        # Сколько запросов еще ждут отправки или отправляются прямо сейчас
+        with self.condition:
+            return self.size + len(self.busy_chats)
+
+    def done(self, chat_id):
+        with self.condition:
+            self.busy_chats.discard(chat_id)
+            self._mark_ready(chat_id)
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            priority, number, task = self.take()
+            try:
+                self.send(priority, number, task)
+            except Exception:
+                logger.exception('Ошибка обработки ответа Telegram')
+            finally:
+                self.done(task['chat_id'])
+
+    def send(self, priority, number, task):
+        self.global_bucket.acquire()
+        task['attempt'] += 1
+        try:
+            with track(SEND_LATENCY, SEND_ERRORS, channel='telegram', method=task['method']):
+                result = getattr(self.bot, task['method'])(
+                    chat_id=task['chat_id'],
+                    **task['kwargs']
+                )
+        except RetryAfter as error:
+            # Telegram просит подождать: притормаживаем всю очередь и повторяем запрос
+            # с прежним местом в очереди
+            self.global_bucket.pause(error.retry_after)
+            self._push(priority, number, task)
+            return
+        except (BadRequest, Unauthorized) as error:
+            self.fail(task, error)
+            return
+        except NetworkError as error:
+            # После таймаута сообщение могло уже дойти: повтор send_* отправил бы его дважды
+            is_unsafe_retry = isinstance(error, TimedOut) and task['method'].startswith('send_')
+            if task['attempt'] < MAX_ATTEMPTS and not is_unsafe_retry:
+                self._push(priority, number, task)
+            else:
+                self.fail(task, error)
+            return
+        if task['on_success']:
+            task['on_success'](result)
+
+    @staticmethod
+    def fail(task, error):
+        if task['on_error']:
+            task['on_error'](error)
+            return
+        logger.warning(
+            'Не удалось выполнить %s для чата %s: %s',
+            task['method'],
+            task['chat_id'],
+            error
+        )
+
+
+class QueuedBot:
+    # Обертка с интерфейсом telegram.Bot: вызов любого метода ставит запрос в очередь
+    def __init__(self, outbound, priority=PRIORITY_REPLY):
+        self.outbound = outbound
+        self.priority = priority
+
+    def __getattr__(self, method):
+        def enqueue(chat_id, on_success=None, on_error=None, **kwargs):
+            self.outbound.put(method, chat_id, self.priority, on_success, on_error, **kwargs)
+        return enqueue
@@ -0,0 +1,131 @@
+import json
+import logging
+import os
+
+from dotenv import load_dotenv
+from flask import Flask, request
+from redis.exceptions import LockError
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from metrics import metrics_view
+from tg_bot import get_db_connection, setup_dispatcher
+
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Telegram может повторно прислать обновление, если не дождался ответа
+UPDATE_DEDUP_TTL = 24 * 3600
+# Блокировка чата держится не дольше, чем gunicorn дает воркеру на запрос (--timeout,
+# по умолчанию 30 с), а ждать ее можно лишь несколько секунд: иначе всплеск
+# сообщений одного чата займет все воркеры и остановит остальные чаты
+CHAT_LOCK_TIMEOUT = 30
+CHAT_LOCK_WAIT = int(os.getenv('TG_CHAT_LOCK_WAIT', 5))
+
+# Сколько раз пробовать обработать обновление, прежде чем отбросить его
+MAX_UPDATE_ATTEMPTS = 3
+
+BOT = Bot(os.environ['TG_TOKEN'])
+# workers=0: обновление обрабатывается прямо в потоке запроса, а параллельность
+# дают воркеры gunicorn
+DISPATCHER = Dispatcher(BOT, None, workers=0)
+setup_dispatcher(DISPATCHER)
+app = Flask(__name__)
+app.add_url_rule('/metrics', 'metrics', metrics_view)
+
+# Dispatcher сам перехватывает исключения обработчиков; обработчик ошибок
+# запоминает их, чтобы process_update мог вернуть Telegram ошибку
+UPDATE_ERRORS = {}
+
+
+def remember_error(update, context):
+    if isinstance(update, Update):
+        UPDATE_ERRORS[update.update_id] = context.error
+
+
+DISPATCHER.add_error_handler(remember_error)
+
+
+def dispatch(update: Update):
+    DISPATCHER.process_update(update)
+    error = UPDATE_ERRORS.pop(update.update_id, None)
+    if error:
+        raise error
+
+
+def process_update(update: Update):
+    db = get_db_connection()
+    chat = update.effective_chat
+    if not chat:
+        if not db.set(f"tg_update:{update.update_id}", 1, nx=True, ex=UPDATE_DEDUP_TTL):
+            return
+        try:
+            dispatch(update)
+        except Exception:
+            # Даем Telegram прислать обновление повторно
+            db.delete(f"tg_update:{update.update_id}")
+            raise
+        return
+
+    # Обновления одного чата обрабатываются строго по очереди и по возрастанию
+    # update_id, даже если пришли в разные воркеры: обновление сначала попадает
+    # в очередь чата, а затем под блокировкой чата очередь разбирается по порядку
+    # до этого обновления включительно
+    pending_key = f"tg_chat_pending:{chat.id}"
+    with db.pipeline() as pipe:
+        pipe.hset(f"{pending_key}:data", update.update_id, json.dumps(update.to_dict()))
+        pipe.zadd(pending_key, {update.update_id: update.update_id})
+        pipe.expire(f"{pending_key}:data", UPDATE_DEDUP_TTL)
+        pipe.expire(pending_key, UPDATE_DEDUP_TTL)
+        pipe.execute()
+    with db.lock(f"tg_chat_lock:{chat.id}", timeout=CHAT_LOCK_TIMEOUT, blocking_timeout=CHAT_LOCK_WAIT):
+        while True:
+            pending = db.zrange(pending_key, 0, 0, withscores=True)
+            if not pending or pending[0][1] > update.update_id:
+                return
+            process_pending_update(db, pending_key, int(pending[0][1]))
+
+
+def process_pending_update(db, pending_key, update_id):
+    # Ошибка оставляет обновление в очереди: его повторит следующий запрос этого чата
+    # или повторная доставка от Telegram; после MAX_UPDATE_ATTEMPTS попыток оно отбрасывается
+    payload = db.hget(f"{pending_key}:data", update_id)
+    if payload and not db.exists(f"tg_update:{update_id}"):
+        try:
+            dispatch(Update.de_json(json.loads(payload), BOT))
+        except Exception:
+            attempts = db.hincrby(f"{pending_key}:attempts", update_id)
+            db.expire(f"{pending_key}:attempts", UPDATE_DEDUP_TTL)
+            if attempts < MAX_UPDATE_ATTEMPTS:
+                raise
+            logger.exception('Обновление %s отброшено после %s попыток', update_id, attempts)
+    with db.pipeline() as pipe:
+        pipe.set(f"tg_update:{update_id}", 1, ex=UPDATE_DEDUP_TTL)
+        pipe.zrem(pending_key, update_id)
+        pipe.hdel(f"{pending_key}:data", update_id)
+        pipe.hdel(f"{pending_key}:attempts", update_id)
+        pipe.execute()
+
+
+@app.route('/telegram/<secret>', methods=['POST'])
+def telegram_webhook(secret):
+    if secret != os.environ['TG_WEBHOOK_SECRET']:
+        return "Forbidden", 403
+    try:
+        process_update(Update.de_json(request.get_json(force=True), BOT))
+    except LockError:
+        # Обновление уже в очереди чата: его разберет текущий владелец блокировки
+        # или повторная доставка от Telegram
+        return "Chat is busy", 503
+    return "ok", 200
+
+
+if __name__ == '__main__':
+    # Регистрация вебхука; сам сервер запускается через gunicorn:
+    #     gunicorn -w 4 tg_webhook:app
+    BOT.set_webhook(
+        f"{os.environ['TG_WEBHOOK_URL']}/telegram/{os.environ['TG_WEBHOOK_SECRET']}",
+        max_connections=int(os.getenv('TG_WEBHOOK_MAX_CONNECTIONS', 40))
+    )
+    BOT.set_my_commands([('start', 'Начать диалог')])
@@ -1,16 +1,27 @@
+import hashlib
+import hmac
+import json
+import logging
 import os
+import threading
+import zlib
+
 from sre_constants import CATEGORY
 
 import redis
-import requests
 from dotenv import load_dotenv
 from flask import Flask, request
 
-from shop import get_auth_token, get_file_link, get_products_by_category_id, add_item_to_cart, get_cart, delete_item
+from messenger import MessengerClient
+from metrics import HANDLER_ERRORS, HANDLER_LATENCY, metrics_view, track
+from shop import (
+    get_product_image_links, get_products_by_category_id, add_item_to_cart,
+    get_cart, delete_item, set_db, configure_client, StoreTokenManager
+)
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 URL = 'https://api.moltin.com'
-SHOP_TOKEN, _ = get_auth_token(URL, os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'))
 CATEGORIES = {
     'front_page': '853639e2-b8de-41f8-99c5-cf26496e96f9',
     'spicy': 'd83ce07a-d60c-44f6-936b-729339db5dab',
@@ -23,7 +34,22 @@ DATABASE = redis.Redis(
     password=os.getenv('DB_PASS'),
     db=0    
 )
+set_db(DATABASE)
+# Токен магазина общий для всех воркеров gunicorn и обновляется заранее
+STORE_TOKENS = StoreTokenManager(DATABASE, URL, os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'))
+configure_client(URL, token_manager=STORE_TOKENS)
+# Все отправки в Messenger идут через один клиент с пулом соединений через прокси
+MESSENGER = MessengerClient(os.getenv('FB_PAGE_ACCESS_TOKEN'), os.getenv('HTTP_PROXY'))
+# События раскладываются по нескольким потокам Redis по отправителю: события одного
+# пользователя всегда попадают в один поток и обрабатываются по порядку
+FB_STREAM = 'fb_events'
+FB_DEAD_LETTER_STREAM = 'fb_events:dead'
+FB_STREAM_PARTITIONS = int(os.getenv('FB_STREAM_PARTITIONS', 8))
+FB_STREAM_MAXLEN = 100000
+MENU_MESSAGES = {}
+MENU_MESSAGES_LOCK = threading.Lock()
 app = Flask(__name__)
+app.add_url_rule('/metrics', 'metrics', metrics_view)
 
 @app.route('/', methods=['GET'])
 def verify():
@@ -46,15 +72,14 @@ def handle_start(sender_id, message_text, postback):
 def handle_menu(sender_id, message_text, postback):
     if postback:
         if postback['payload'] in CATEGORIES.values():
-            print(postback['payload'])
             send_menu(sender_id, postback['payload'])
             return 'MENU_AWAITING'
         elif postback['title'] == 'Корзина':
-            cart = get_cart(SHOP_TOKEN, URL, sender_id)
+            cart = get_cart(STORE_TOKENS.get(), URL, sender_id)
             send_cart(sender_id, cart)
             return 'CART'
         elif postback['title'] == 'В корзину':
-            add_item_to_cart(SHOP_TOKEN, URL, sender_id, postback['payload'], 1)
+            add_item_to_cart(STORE_TOKENS.get(), URL, sender_id, postback['payload'], 1)
             send_message(sender_id, "Добавили в заказ")
             return 'MENU_AWAITING'
     return 'MENU_AWAITING'
@@ -64,11 +89,11 @@ def handle_cart(sender_id, message_text, postback):
     if not postback:
         return 'CART'
     if postback['title'] == 'Добавить еще одну':
-        cart = add_item_to_cart(SHOP_TOKEN, URL, sender_id, postback['payload'], 1)
+        cart = add_item_to_cart(STORE_TOKENS.get(), URL, sender_id, postback['payload'], 1)
         send_cart(sender_id, cart)
         return 'CART'
     elif postback['title'] == 'Убрать из заказа':
-        cart = delete_item(SHOP_TOKEN, URL, sender_id, postback['payload'])
+        cart = delete_item(STORE_TOKENS.get(), URL, sender_id, postback['payload'])
         send_cart(sender_id, cart)
         return 'CART'
     elif postback['title'] == 'К меню':
@@ -91,211 +116,220 @@ def handle_users_reply(sender_id, message_text, postback):
         user_state = recorded_state.decode('utf-8')
     if message_text == "/start":
         user_state = "START"
-    print(user_state)
-    state_handler = states_functions[user_state]
-    next_state = state_handler(sender_id, message_text, postback)
+    logger.debug('Пользователь %s в состоянии %s', sender_id, user_state)
+    with track(HANDLER_LATENCY, HANDLER_ERRORS, bot='messenger', state=user_state):
+        state_handler = states_functions[user_state]
+        next_state = state_handler(sender_id, message_text, postback)
     DATABASE.set(f"fb_{sender_id}", next_state.encode('utf-8'))
 
 
+def is_valid_signature(payload, signature):
+    app_secret = os.getenv('FB_APP_SECRET')
+    if not app_secret:
+        return True
+    expected = 'sha256=' + hmac.new(app_secret.encode(), payload, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature or '')
+
+
+def get_stream_name(sender_id):
+    return f"{FB_STREAM}:{zlib.crc32(str(sender_id).encode()) % FB_STREAM_PARTITIONS}"
+
+
+def handle_messaging_event(messaging_event):
+    sender_id = messaging_event["sender"]["id"]  # the facebook ID of the person sending you the message
+    if messaging_event.get("message"):  # someone sent us a message
+        message_text = messaging_event['message'].get("text")  # the message's text
+        handle_users_reply(sender_id, message_text, None)
+    elif messaging_event.get('postback'):
+        handle_users_reply(sender_id, None, messaging_event['postback'])
+
+
 @app.route('/', methods=['POST'])
 def webhook():
     """
     Основной вебхук, на который будут приходить сообщения от Facebook.
+    События только проверяются и кладутся в очередь, а обрабатывает их fb_worker.py,
+    поэтому Facebook получает ответ сразу.
     """
-    data = request.get_json()
-    print(data)
-    message_text=None
-    postback=None
-    if data["object"] == "page":
-        for entry in data["entry"]:
-            for messaging_event in entry["messaging"]:
-                if messaging_event.get("message"):  # someone sent us a message
-                    sender_id = messaging_event["sender"]["id"]  # the facebook ID of the person sending you the message
-                    recipient_id = messaging_event["recipient"]["id"] # the recipient's ID, which should be your page's facebook ID
-                    message_text = messaging_event['message']["text"] # the message's text
-                    handle_users_reply(sender_id, message_text, postback)
-                elif messaging_event.get('postback'):
-                    sender_id = messaging_event["sender"]["id"]
-                    postback = messaging_event.get('postback')
-
-                    handle_users_reply(sender_id, message_text, postback)
+    if not is_valid_signature(request.get_data(), request.headers.get('X-Hub-Signature-256')):
+        return "Invalid signature", 403
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return "Bad request", 400
+    if data.get("object") != "page":
+        return "ok", 200
+    with DATABASE.pipeline(transaction=False) as pipe:
+        for entry in data.get("entry", []):
+            for messaging_event in entry.get("messaging", []):
+                if not messaging_event.get("sender"):
+                    continue
+                pipe.xadd(
+                    get_stream_name(messaging_event["sender"]["id"]),
+                    {'event': json.dumps(messaging_event)},
+                    maxlen=FB_STREAM_MAXLEN,
+                    approximate=True
+                )
+        pipe.execute()
     return "ok", 200
 
 
+def get_menu_message(category_id):
+    # Меню одинаково для всех пользователей, поэтому сериализуется один раз
+    # на каждую категорию и версию каталога. Каталог приходит из кэша, и пока
+    # кэш отдает тот же список товаров, используется готовое меню
+    products = get_products_by_category_id(STORE_TOKENS.get(), URL, category_id)['data']
+    with MENU_MESSAGES_LOCK:
+        cached_products, message = MENU_MESSAGES.get(category_id, (None, None))
+        if cached_products is products:
+            return message
+    message = json.dumps(render_menu(products), ensure_ascii=False).encode('utf-8')
+    with MENU_MESSAGES_LOCK:
+        MENU_MESSAGES[category_id] = (products, message)
+    return message
+
+
+def prerender_menus():
+    for category_id in CATEGORIES.values():
+        get_menu_message(category_id)
+
+
 def send_menu(recipient_id, category_id=CATEGORIES['front_page']):
-    products = get_products_by_category_id(SHOP_TOKEN, URL, category_id)['data']
-    http_proxy = os.environ['HTTP_PROXY']
-    proxies = { 
-              "http": http_proxy,
-              "https": http_proxy,
-            }
-    params = {"access_token": os.environ["FB_PAGE_ACCESS_TOKEN"]}
-    headers = {"Content-Type": "application/json"}
-    request_content = {
-        "recipient": {
-            "id": recipient_id
-        },
-        "message": {
-            "attachment": {
-                "type": "template",
-                "payload": {
-                    "template_type": "generic",
-                    "elements": [
-                        {
-                            "title": "Пиццерия",
-                            "image_url": "https://www.clipartkey.com/mpngs/m/74-747872_diner-clipart-lasagna-logo-pizza-vector-png.png",
-                            "buttons":
-                                [
-                                    {
-                                        "type": "postback",
-                                        "title": "Корзина",
-                                        "payload": "Корзина"
-                                    },
-                                    {
-                                        "type": "postback",
-                                        "title": "Акции",
-                                        "payload": "Акции"                               
-                                    },
-                                    {
-                                        "type": "postback",
-                                        "title": "Сделать заказ",
-                                        "payload": "Сделать заказ"
-                                    }
-                                ]
-                        }
-                    ] + [
-                        {
-                            "title": f"{product['name']} {product['price'][0]['amount']} р.",
-                            "subtitle": product['description'],
-                            "image_url": get_file_link(SHOP_TOKEN, URL, product['relationships']['main_image']['data']['id']),
-                            "buttons": [
+    MESSENGER.send_serialized(recipient_id, get_menu_message(category_id))
+
+
+def render_menu(products):
+    image_links = get_product_image_links(STORE_TOKENS.get(), URL, products)
+    message = {
+        "attachment": {
+            "type": "template",
+            "payload": {
+                "template_type": "generic",
+                "elements": [
+                    {
+                        "title": "Пиццерия",
+                        "image_url": "https://www.clipartkey.com/mpngs/m/74-747872_diner-clipart-lasagna-logo-pizza-vector-png.png",
+                        "buttons":
+                            [
                                 {
                                     "type": "postback",
-                                    "title": "В корзину",
-                                    "payload": product['sku']
+                                    "title": "Корзина",
+                                    "payload": "Корзина"
+                                },
+                                {
+                                    "type": "postback",
+                                    "title": "Акции",
+                                    "payload": "Акции"                               
+                                },
+                                {
+                                    "type": "postback",
+                                    "title": "Сделать заказ",
+                                    "payload": "Сделать заказ"
+                                }
+                            ]
+                    }
+                ] + [
+                    {
+                        "title": f"{product['name']} {product['price'][0]['amount']} р.",
+                        "subtitle": product['description'],
+                        "image_url": image_links.get(product['id']),
+                        "buttons": [
+                            {
+                                "type": "postback",
+                                "title": "В корзину",
+                                "payload": product['sku']
+                            }
+                        ]
+                    } for product in products
+                ] + [
+                    {
+                        "title": "Не нашли пиццу по вкусу?",
+                        "subtitle": 'Другие категории здесь',
+                        "image_url": "https://primepizza.ru/uploads/position/large_0c07c6fd5c4dcadddaf4a2f1a2c218760b20c396.jpg",
+                        "buttons":
+                            [
+                                {
+                                    "type": "postback",
+                                    "title": "Особые",
+                                    "payload": CATEGORIES['special']
+                                },
+                                {
+                                    "type": "postback",
+                                    "title": "Сытные",
+                                    "payload": CATEGORIES['nourishing']                               
+                                },
+                                {
+                                    "type": "postback",
+                                    "title": "Острые",
+                                    "payload": CATEGORIES['spicy']
                                 }
                             ]
-                        } for product in products
-                    ] + [
-                        {
-                            "title": "Не нашли пиццу по вкусу?",
-                            "subtitle": 'Другие категории здесь',
-                            "image_url": "https://primepizza.ru/uploads/position/large_0c07c6fd5c4dcadddaf4a2f1a2c218760b20c396.jpg",
-                            "buttons":
-                                [
-                                    {
-                                        "type": "postback",
-                                        "title": "Особые",
-                                        "payload": CATEGORIES['special']
-                                    },
-                                    {
-                                        "type": "postback",
-                                        "title": "Сытные",
-                                        "payload": CATEGORIES['nourishing']                               
-                                    },
-                                    {
-                                        "type": "postback",
-                                        "title": "Острые",
-                                        "payload": CATEGORIES['spicy']
-                                    }
-                                ]
-                        }                        
-                    ]
-                }
+                    }                        
+                ]
             }
         }
     }
-    response = requests.post("https://graph.facebook.com/v14.0/me/messages", params=params, headers=headers, json=request_content, proxies=proxies)
-    response.raise_for_status()   
+    return message
 
 
 def send_cart(recipient_id, cart):
-    print(cart)
-    http_proxy = os.environ['HTTP_PROXY']
-    proxies = { 
-              "http": http_proxy,
-              "https": http_proxy,
-            }
-    params = {"access_token": os.environ["FB_PAGE_ACCESS_TOKEN"]}
-    headers = {"Content-Type": "application/json"}
-    request_content = {
-        "recipient": {
-            "id": recipient_id
-        },
-        "message": {
-            "attachment": {
-                "type": "template",
-                "payload": {
-                    "template_type": "generic",
-                    "elements": [
-                        {
-                            "title": "Ваша корзина",
-                            "image_url": "https://postium.ru/wp-content/uploads/2018/08/idealnaya-korzina-internet-magazina-1068x713.jpg",
-                            "buttons":
-                                [
-                                    {
-                                        "type": "postback",
-                                        "title": "Самомвывоз",
-                                        "payload": "Самовывоз"
-                                    },
-                                    {
-                                        "type": "postback",
-                                        "title": "Доставка",
-                                        "payload": "Доставка"                               
-                                    },
-                                    {
-                                        "type": "postback",
-                                        "title": "К меню",
-                                        "payload": "К меню"
-                                    }
-                                ]
-                        }
-                    ] + [
-                        {
-                            "title": f"{item['name']} - {item['quantity']} шт.",
-                            'subtitle': item.get('description'),
-                            'image_url': item.get('image'),
-                            'buttons': [
+    message = {
+        "attachment": {
+            "type": "template",
+            "payload": {
+                "template_type": "generic",
+                "elements": [
+                    {
+                        "title": "Ваша корзина",
+                        "image_url": "https://postium.ru/wp-content/uploads/2018/08/idealnaya-korzina-internet-magazina-1068x713.jpg",
+                        "buttons":
+                            [
                                 {
                                     "type": "postback",
-                                    "title": "Добавить еще одну",
-                                    "payload": item['sku']
+                                    "title": "Самомвывоз",
+                                    "payload": "Самовывоз"
                                 },
                                 {
                                     "type": "postback",
-                                    "title": "Убрать из заказа",
-                                    "payload": item['id']
+                                    "title": "Доставка",
+                                    "payload": "Доставка"                               
+                                },
+                                {
+                                    "type": "postback",
+                                    "title": "К меню",
+                                    "payload": "К меню"
                                 }
                             ]
-                        } for item in cart['items']
-                    ]
-                }
+                    }
+                ] + [
+                    {
+                        "title": f"{item['name']} - {item['quantity']} шт.",
+                        'subtitle': item.get('description'),
+                        'image_url': item.get('image'),
+                        'buttons': [
+                            {
+                                "type": "postback",
+                                "title": "Добавить еще одну",
+                                "payload": item['sku']
+                            },
+                            {
+                                "type": "postback",
+                                "title": "Убрать из заказа",
+                                "payload": item['id']
+                            }
+                        ]
+                    } for item in cart['items']
+                ]
             }
         }
     }
-    response = requests.post("https://graph.facebook.com/v14.0/me/messages", params=params, headers=headers, json=request_content, proxies=proxies)
-    print(response.json())
-    response.raise_for_status()   
+    MESSENGER.send(recipient_id, message)
 
 
 def send_message(recipient_id, message_text):
-    http_proxy = os.environ['HTTP_PROXY']
-    proxies = { 
-              "http": http_proxy,
-              "https": http_proxy,
-            }
-    params = {"access_token": os.environ["FB_PAGE_ACCESS_TOKEN"]}
-    headers = {"Content-Type": "application/json"}
-    request_content = {
-        "recipient": {
-            "id": recipient_id
-        },
-        "message": {
-            "text": message_text
-        }
+    message = {
+        "text": message_text
     }
-    response = requests.post("https://graph.facebook.com/v14.0/me/messages", params=params, headers=headers, json=request_content, proxies=proxies)
-    response.raise_for_status()
+    MESSENGER.send(recipient_id, message)
 
 
 if __name__ == '__main__':